@@ -1,10 +1,20 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from causalchains.utils.data_utils import EOS_TOK, SOS_TOK
 
-class EventLM(nn.Module): 
+class EventLM(nn.Module):
 
-    def __init__(self, ninput, nhidden, nlayers, nvocab, vocab=None, rnn_type="GRU", dropout=0.1):
+    def __init__(self, ninput, nhidden, nlayers, nvocab, vocab=None, rnn_type="GRU", dropout=0.1, adaptive_cutoffs=None, adaptive_div=4.0, adaptive_head=None):
+        """
+        Params:
+            adaptive_cutoffs (list) : If given, use an adaptive softmax output with these cluster cutoffs instead of the full linear_out layer
+                                      (event ids need to be roughly sorted by frequency, which the torchtext vocab is)
+            adaptive_head (list) : ids to put first in the adaptive softmax, ahead of the rest of the vocab, for frequent ids that
+                                   are not at the front of the vocab (EOS, which convert_to_lm_vocab appends at the end, is the last
+                                   target of every sequence)
+        """
 
         super(EventLM, self).__init__()
 
@@ -14,30 +24,100 @@ class EventLM(nn.Module):
 
         self.rnn = nn.GRU(ninput, nhidden, nlayers, batch_first=True)
         # logit layer
-        self.linear_out = nn.Linear(nhidden, nvocab)
-        
+        if adaptive_cutoffs:
+            self.adaptive_softmax = nn.AdaptiveLogSoftmaxWithLoss(nhidden, nvocab, cutoffs=list(adaptive_cutoffs), div_value=adaptive_div)
+            head = list(adaptive_head or [])
+            order = torch.LongTensor(head + [i for i in range(nvocab) if i not in set(head)]) #adaptive softmax class -> event id
+            adaptive_ids = torch.empty_like(order)
+            adaptive_ids[order] = torch.arange(nvocab)
+            self.register_buffer('adaptive_ids', adaptive_ids) #event id -> adaptive softmax class
+        else:
+            self.linear_out = nn.Linear(nhidden, nvocab)
+            self.adaptive_softmax = None
+
         self.rnn_type = rnn_type
         self.nhidden = nhidden
         self.nlayers = nlayers
         self.vocab = vocab
 
 
-    def forward(self, input, hidden): 
+    def forward(self, input, hidden, lengths=None):
         """
         dropout is on the input and output
 
-        input is a [batch, 1] size Tensor 
+        input is a [batch, seqlen] size Tensor (seqlen is 1 when stepping through one event at a time)
+        lengths (optional) is a [batch] Tensor for padded input, sorted by decreasing length, the rnn only runs over the real events
+        With the adaptive softmax, the returned logits are the (exact) log probabilities, so they can be used the same way
         """
-        batch_size = input.size(0)
-        # word embedding [batch X 1 X emb_dim]
+        output, hidden = self.encode(input, hidden, lengths)
+        # logit is [batch_size*seqlen , vocab]
+        logit = self.output_logits(output)
+        return logit, hidden
+
+
+    def encode(self, input, hidden, lengths=None):
+        'Run the rnn over the whole input without the output layer, returns output [batch*seqlen X nhidden] and hidden'
+        # word embedding [batch X seqlen X emb_dim]
         emb = self.dropout(self.embedding(input))
 
-        output, hidden = self.rnn(emb, hidden)
+        if lengths is not None:
+            packed = pack_padded_sequence(emb, lengths.cpu(), batch_first=True)
+            output, hidden = self.rnn(packed, hidden)
+            output, _ = pad_packed_sequence(output, batch_first=True, total_length=input.size(1))
+        else:
+            output, hidden = self.rnn(emb, hidden)
 
-        # output [batch_size, 1, hidden_size]
+        # output [batch_size, seqlen, hidden_size]
         output = self.dropout(output)
-        # logit is [batch_size , vocab]
-        logit = self.linear_out(output.view(output.size(0)*output.size(1), output.size(2))) 
-        return logit, hidden
+        return output.contiguous().view(output.size(0)*output.size(1), output.size(2)), hidden
+
+
+    def sequence_loss(self, input, lengths, targets, target_lengths):
+        """
+        Average per event loss over a padded batch, in one pass over the whole sequence.
+        The output layer is only evaluated at the non pad positions.
+        Params:
+            input (Tensor) : [batch X seqlen] input events (starting with SOS), sorted by decreasing length
+            lengths (Tensor) : [batch]
+            targets (Tensor) : [batch X seqlen] (ending with EOS)
+            target_lengths (Tensor) : [batch]
+        """
+        output, _ = self.encode(input, None, lengths) #[batch*seqlen X nhidden]
+        mask = torch.arange(targets.size(1), device=targets.device).unsqueeze(0) < target_lengths.unsqueeze(1)
+        mask = mask.view(-1)
+        output = output[mask]
+        targets = targets.contiguous().view(-1)[mask]
+        if self.uses_adaptive_softmax():
+            return self.adaptive_softmax(output, self.adaptive_classes(targets)).loss
+        return F.cross_entropy(self.linear_out(output), targets)
+
+
+    def output_logits(self, output):
+        'output [N X nhidden] from encode -> logits [N X vocab]'
+        if self.uses_adaptive_softmax():
+            log_probs = self.adaptive_softmax.log_prob(output)
+            adaptive_ids = getattr(self, 'adaptive_ids', None) #models saved before adaptive_head use the vocab order
+            return log_probs if adaptive_ids is None else log_probs[:, adaptive_ids]
+        return self.linear_out(output)
+
+
+    def prefix_logits(self, prefix):
+        """
+        Run over a whole prefix at once and get the logits for the next event
+        Params:
+            prefix (Tensor) : LongTensor [seqlen] of event ids (starting with SOS)
+        Returns:
+            logits [1 X vocab] for the event after prefix, and the hidden state
+        """
+        output, hidden = self.encode(prefix.view(1, -1), None)
+        return self.output_logits(output[-1:]), hidden
+
+
+    def adaptive_classes(self, targets):
+        'Event ids -> adaptive softmax classes'
+        adaptive_ids = getattr(self, 'adaptive_ids', None)
+        return targets if adaptive_ids is None else adaptive_ids[targets]
 
 
+    def uses_adaptive_softmax(self):
+        return getattr(self, 'adaptive_softmax', None) is not None #older saved models dont have the attribute
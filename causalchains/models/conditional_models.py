@@ -3,17 +3,45 @@
 ################################################
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 import math
 import logging
 import causalchains.utils.data_utils as du
 from causalchains.utils.data_utils import PAD_TOK
+from causalchains.models.encoders.onehot_encoder import MultiHot
 from collections import namedtuple
 
 EmptyEncoder = namedtuple('EmptyEncoder', ['output_dim'])
 dummy = EmptyEncoder(0)
 
 
+def term_logits(weight, bias, layer_input):
+    'Logits [batch X out dim] of one output term, F.linear for a dense input, a gather-sum over the columns of weight for a MultiHot'
+    if isinstance(layer_input, MultiHot):
+        ids, valid = layer_input
+        logits = weight.new_zeros(ids.shape[0], weight.shape[0]) if bias is None else bias.unsqueeze(0).expand(ids.shape[0], weight.shape[0])
+        for pos in range(ids.shape[1]): #one event position at a time, so nothing bigger than [batch X out dim] is ever made
+            logits = logits + weight[:, ids[:, pos]].t() * valid[:, pos].unsqueeze(1)
+        return logits
+    return F.linear(layer_input, weight, bias)
+
+
+def term_sampled_logits(weight, bias, layer_input, targets, sampled):
+    'Like term_logits, but just for the rows targets ([batch], one per instance) and sampled ([num sampled], for all of them)'
+    if isinstance(layer_input, MultiHot):
+        ids, valid = layer_input
+        target_logits = (weight[targets.unsqueeze(1), ids] * valid).sum(dim=1) #[batch]
+        sampled_logits = (weight[sampled.view(1, -1, 1), ids.unsqueeze(1)] * valid.unsqueeze(1)).sum(dim=2) #[batch X num sampled]
+    else:
+        target_logits = (layer_input * weight[targets]).sum(dim=1)
+        sampled_logits = F.linear(layer_input, weight[sampled])
+    if bias is not None:
+        target_logits = target_logits + bias[targets]
+        sampled_logits = sampled_logits + bias[sampled]
+    return target_logits, sampled_logits
+
+
 class ExpectedOutcome(nn.Module):
     'Models E[e2 | e1, e1_text], Use Embeddings for event representation'
 
@@ -44,7 +72,7 @@ class ExpectedOutcome(nn.Module):
 
         self.e_pad = evocab.stoi[PAD_TOK]
         self.t_pad = tvocab.stoi[PAD_TOK]
-        assert self.e_pad == self.event_embeddings.padding_idx
+        assert self.event_embeddings is None or self.e_pad == self.event_embeddings.padding_idx #None for onehot events
         assert self.t_pad == self.text_embeddings.padding_idx
         self.combine_events = config.combine_events
         self.rnn_event_encoder = config.rnn_event_encoder
@@ -96,6 +124,33 @@ class ExpectedOutcome(nn.Module):
         outputs:
             logits for e2 prediction, Tensor of [batch X num events]
         """
+        return sum([term_logits(weight, bias, layer_input) for weight, bias, layer_input in self.output_terms(input)])
+
+
+    def sampled_logits(self, input, targets, sampled):
+        """
+        Logits for just a few of the output events, for sampled softmax training (only the needed rows of the output layer are used)
+        Params:
+            (torchtext.Example) : same as forward
+            (Tensor) targets : LongTensor [batch], the true e2 for each instance
+            (Tensor) sampled : LongTensor [num sampled], events sampled for the whole batch
+        outputs:
+            (Tensor [batch] logits of targets, Tensor [batch X num sampled] logits of the sampled events)
+        """
+        target_logits, sampled_logits = 0, 0
+        for weight, bias, layer_input in self.output_terms(input):
+            term_target, term_sampled = term_sampled_logits(weight, bias, layer_input, targets, sampled)
+            target_logits = target_logits + term_target
+            sampled_logits = sampled_logits + term_sampled
+        return target_logits, sampled_logits
+
+
+    def output_terms(self, input):
+        """
+        Run the encoders, the logits are the sum of term_logits(weight, bias, layer_input) over the returned terms
+        outputs:
+            list of (weight [num events X input dim], bias or None, Tensor [batch X input dim] or MultiHot for onehot events)
+        """
 
         e1_text = self.text_embeddings(input.e1_text[0]) #[batch, toklength, embd size]
         text_mask = du.create_mask(input.e1_text[0], input.e1_text[1])
@@ -103,11 +158,10 @@ class ExpectedOutcome(nn.Module):
 
         if self.includes_e1prev_intext():
             if self.onehot_events():
-                e1 = self.event_encoder(input.e1.unsqueeze(dim=1), None) #batch x vocsize   #Get one hot encodings
-                e1prev = self.event_encoder(input.e1prev_intext[0], None) #batch x vocsize
-                events = e1 + e1prev
-                events = torch.where(events < 2, events, torch.ones(events.shape, dtype=events.dtype, device=events.device)) #make sure all features are binary (not greater than 2)
-                mlp_input = torch.cat([events, encoded_text], dim=1)
+                #Binary features for e1 and the previous events, kept as index lists instead of a [batch x vocsize] vector
+                events = self.event_encoder.multihot(torch.cat([input.e1.unsqueeze(dim=1), input.e1prev_intext[0]], dim=1))
+                weight = self.logits_mlp.weight
+                return [(weight[:, :self.num_events], None, events), (weight[:, self.num_events:], self.logits_mlp.bias, encoded_text)]
             elif self.finetune:
                 allprev_emb = self.event_embeddings(input.allprev[0]) #[batch, maxlen, embdsize]
                 encoded_events = self.event_encoder(allprev_emb, input.allprev[1])
@@ -133,9 +187,93 @@ class ExpectedOutcome(nn.Module):
             mlp_input = torch.cat([e1, encoded_text], dim=1)
 
         if not self.finetune:
-            return self.logits_mlp(mlp_input)
+            return [(self.logits_mlp.weight, self.logits_mlp.bias, mlp_input)]
         else:
-            return self.logits_mlp(mlp_input) + self.event_text_logits_mlp(event_text_mlp_input)
+            return [(self.logits_mlp.weight, self.logits_mlp.bias, mlp_input), (self.event_text_logits_mlp.weight, self.event_text_logits_mlp.bias, event_text_mlp_input)]
+
+
+    def encode_context(self, input):
+        """
+        Encode everything in input that stays fixed when we intervene on e1 (the text and the previous events),
+        so the logits under many different interventions can be gotten from intervened_logits without rerunning the encoders.
+        Since the last layer is linear, the logits split into a part without e1 and a part coming from e1
+        Params:
+            (torchtext.Example) : An example from an data_utils.InstanceDataset, the e1 and allprev fields are ignored,
+                                  assumes the batch is sorted by decreasing e1prev_intext length (for rnn encoders)
+        outputs:
+            (dict) context, 'base' maps to the logits with e1 left out, Tensor of [batch X num events], the rest is
+            whatever intervened_logits needs to add e1 back in
+        """
+        e1_text = self.text_embeddings(input.e1_text[0]) #[batch, toklength, embd size]
+        text_mask = du.create_mask(input.e1_text[0], input.e1_text[1])
+        encoded_text = self.text_encoder(e1_text, mask=text_mask) #[batch, outputsize]
+        text_dim = self.text_encoder.output_dim
+        weight = self.logits_mlp.weight
+        context = {}
+
+        if self.includes_e1prev_intext():
+            if self.onehot_events():
+                prev_events = self.event_encoder.multihot(input.e1prev_intext[0])
+                context['event_weight'] = weight[:, :self.num_events]
+                context['prev_events'] = prev_events #e1 only adds a feature if it isnt already on
+                base = term_logits(weight[:, :self.num_events], None, prev_events) + F.linear(encoded_text, weight[:, self.num_events:], self.logits_mlp.bias)
+            elif self.finetune:
+                out_event_mask = du.create_mask(input.e1prev_outtext[0], input.e1prev_outtext[1])
+                encoded_out_events = self.out_event_encoder(self.event_embeddings(input.e1prev_outtext[0]), input.e1prev_outtext[1], out_event_mask)
+                event_text_weight = self.event_text_logits_mlp.weight
+                context['event_weight'] = event_text_weight[:, text_dim:]
+                context['prefix_state'] = self.event_encoder.encode_prefix(self.event_embeddings(input.e1prev_intext[0]), input.e1prev_intext[1])
+                base = self.logits_mlp(encoded_out_events) + F.linear(encoded_text, event_text_weight[:, :text_dim], self.event_text_logits_mlp.bias)
+            elif self.rnn_event_encoder: #e1 is the last step of allprev
+                context['event_weight'] = weight[:, text_dim:]
+                context['prefix_state'] = self.event_encoder.encode_prefix(self.event_embeddings(input.e1prev_intext[0]), input.e1prev_intext[1])
+                base = F.linear(encoded_text, weight[:, :text_dim], self.logits_mlp.bias)
+            elif self.combine_events: #e1 gets averaged in with the previous events
+                event_mask = du.create_mask(input.e1prev_intext[0], input.e1prev_intext[1])
+                encoded_events = self.event_encoder(self.event_embeddings(input.e1prev_intext[0]), input.e1prev_intext[1], event_mask)
+                context['event_weight'] = weight[:, text_dim:]
+                context['scale'] = 1.0 / (input.e1prev_intext[1].float().to(device=encoded_text.device) + 1) #the avg encoder divides by length + 1
+                base = F.linear(torch.cat([encoded_text, encoded_events], dim=1), weight, self.logits_mlp.bias)
+            else: #Regular avg encoder
+                event_mask = du.create_mask(input.e1prev_intext[0], input.e1prev_intext[1])
+                encoded_events = self.event_encoder(self.event_embeddings(input.e1prev_intext[0]), input.e1prev_intext[1], event_mask)
+                context['event_weight'] = weight[:, :self.event_embed_dim]
+                base = F.linear(torch.cat([encoded_text, encoded_events], dim=1), weight[:, self.event_embed_dim:], self.logits_mlp.bias)
+        else:
+            context['event_weight'] = weight[:, :self.event_embed_dim]
+            base = F.linear(encoded_text, weight[:, self.event_embed_dim:], self.logits_mlp.bias)
+
+        context['base'] = base
+        return context
+
+
+    def intervened_logits(self, context, e1):
+        """
+        Params:
+            (dict) context : output of encode_context for a batch
+            (Tensor) e1 : LongTensor [num e1] of the events to intervene with
+        outputs:
+            logits for e2 prediction under each intervention do(e1), Tensor of [num e1 X batch X num events]
+        """
+        base = context['base'].unsqueeze(0) #[1, batch, num events]
+        event_weight = context['event_weight']
+
+        if 'prefix_state' in context: #rnn encoder, run one more step with e1 as input
+            prefix_state = context['prefix_state'] #[batch, hidden]
+            num_e1, batch = e1.shape[0], prefix_state.shape[0]
+            e1_emb = self.event_embeddings(e1).unsqueeze(1).expand(num_e1, batch, self.event_embed_dim).contiguous()
+            state = self.event_encoder.step(e1_emb.view(num_e1*batch, -1), prefix_state.repeat(num_e1, 1))
+            e1_logits = F.linear(state, event_weight).view(num_e1, batch, -1)
+        elif 'prev_events' in context:
+            ids, valid = context['prev_events']
+            present = ((ids.unsqueeze(0) == e1.view(-1, 1, 1)).float() * valid.unsqueeze(0)).sum(dim=2) > 0 #[num e1 X batch], e1 already among the previous events
+            e1_logits = event_weight[:, e1].t().unsqueeze(1) * (1 - present.float()).unsqueeze(2)
+        else:
+            e1_logits = F.linear(self.event_embeddings(e1), event_weight).unsqueeze(1) #[num e1, 1, num events]
+            if 'scale' in context:
+                e1_logits = e1_logits * context['scale'].view(1, -1, 1)
+
+        return base + e1_logits
 
 
     def includes_e1prev_intext(self):
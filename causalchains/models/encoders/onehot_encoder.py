@@ -1,5 +1,9 @@
 import torch
 import torch.nn as nn
+from collections import namedtuple
+
+#Multi hot features as index lists: ids [batch X n] LongTensor, valid [batch X n] FloatTensor (1 for an active feature, 0 for pads/repeats)
+MultiHot = namedtuple('MultiHot', ['ids', 'valid'])
 
 
 #Class is pretty much here for consitancy
@@ -10,21 +14,15 @@ class OneHotEncoder(nn.Module):
         self.pad_idx = pad_idx
 
 
-    def forward(self, tokens: torch.Tensor, lengths: torch.Tensor):  # pylint: disable=arguments-differ
+    def multihot(self, tokens: torch.Tensor):
         """
+        Binary features of the tokens, kept as each row's distinct non pad ids instead of a vocab sized vector
         Params:
             Tokens (Tensor[batch, maxlength]) : the token ids 
-            lengths (Tensor[batch])
         returns:
-            Tensor[batch, vocab dim]
-            
+            MultiHot, with ids [batch, maxlength] (sorted within rows) and valid 0 for the pads and repeated ids
         """
-
-        tokens = tokens.unsqueeze(dim=2)
-        pad_selector = torch.zeros(tokens.shape, dtype=tokens.dtype, device=tokens.device).fill_(self.pad_idx)
-        onehot = torch.zeros(tokens.shape[0], tokens.shape[1], self.output_dim, device=tokens.device).scatter(2, tokens, 1) #[batch, maxlen, vocabsize]
-        onehot = onehot.scatter(2, pad_selector, 0) #zero out the pad element
-        onehot = onehot.sum(dim=1) #[batch, vocabsize]
-        outhot = torch.where(onehot < 2, onehot, torch.ones(onehot.shape, device=onehot.device)) #make sure all features are binary (not greater than 2)
-
-        return onehot
+        ids, _ = tokens.sort(dim=1)
+        valid = ids != self.pad_idx
+        valid[:, 1:] = valid[:, 1:] & (ids[:, 1:] != ids[:, :-1]) #after sorting, repeats are next to each other
+        return MultiHot(ids, valid.float())
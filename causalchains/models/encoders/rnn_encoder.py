@@ -27,3 +27,30 @@ class RnnEncoder(nn.Module):
         last_state=last_state.squeeze(dim=0)
         return last_state
 
+    def encode_prefix(self, tokens: torch.Tensor, lengths: torch.Tensor):
+        """
+        Same as forward, except sequences may be empty (length zero), these get the initial (zero) state
+        Like forward, assumes the batch is sorted by decreasing length
+        Params:
+            Tokens (Tensor[batch, maxlength, dim]) : the input embeddings
+            lengths (Tensor[batch])
+        Outputs:
+            encoded states (Tensor[batch, output_size])
+        """
+        state = tokens.new_zeros(tokens.shape[0], self.hidden_dim)
+        nonempty = int((lengths > 0).sum())
+        if nonempty > 0:
+            state[:nonempty] = self.forward(tokens[:nonempty], lengths[:nonempty])
+        return state
+
+    def step(self, tokens: torch.Tensor, state: torch.Tensor):
+        """
+        Run the rnn a single step forward from state
+        Params:
+            Tokens (Tensor[batch, dim]) : the input embeddings for the step
+            state (Tensor[batch, output_size]) : the state to continue from (ie output of encode_prefix)
+        Outputs:
+            encoded states (Tensor[batch, output_size])
+        """
+        _, next_state = self.rnn(tokens.unsqueeze(1), state.unsqueeze(0).contiguous())
+        return next_state.squeeze(dim=0)
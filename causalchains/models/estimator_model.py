@@ -16,6 +16,7 @@ from causalchains.models.encoders.average_encoder import AverageEncoder
 from causalchains.models.encoders.onehot_encoder import OneHotEncoder
 from causalchains.models.encoders.rnn_encoder import RnnEncoder
 from causalchains.utils.data_utils import PAD_TOK
+from causalchains.utils.pretrained_cache import load_pretrained_matrix
 import logging
 
 
@@ -47,8 +48,9 @@ class Estimator(nn.Module):
 
         self.text_embeddings = nn.Embedding(tvocab_size, self.text_embed_size, padding_idx=t_pad)
         if config.use_pretrained:
-            logging.info("Estimator: Using Pretrained Word Embeddings")
-            self.text_embeddings.weight.data = tvocab.vectors
+            logging.info("Estimator: Using Pretrained Word Embeddings from {}".format(config.pretrained_embeddings))
+            pretrained = load_pretrained_matrix(config.pretrained_embeddings, tvocab_size, self.text_embed_size)
+            self.text_embeddings.weight.data.copy_(torch.from_numpy(np.array(pretrained)))
 
         if self.event_encoder_outsize is not None: 
             if self.event_embed_size is not None and config.rnn_event_encoder:
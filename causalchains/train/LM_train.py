@@ -13,6 +13,7 @@ import torch.nn.functional as F
 import causalchains.utils.data_utils as du
 from causalchains.utils.data_utils import PAD_TOK, EOS_TOK, SOS_TOK
 from causalchains.models import LM
+from causalchains.utils.prefetch import PrefetchBatches, ExampleBatchPlan
 import time
 from torchtext.vocab import GloVe
 import pickle
@@ -21,7 +22,9 @@ import glob
 import sys
 import os
 import logging
-from causalchains.train.masked_cross_entropy import masked_cross_entropy
+from causalchains.train.masked_cross_entropy import sequence_nll
+import causalchains.train.distributed as distributed
+from causalchains.train.telemetry import Telemetry, lm_instance_tokens
 
 def tally_parameters(model):
     n_params = sum([p.nelement() for p in model.parameters()])
@@ -36,6 +39,22 @@ def check_save_model_path(save_model):
         os.makedirs(model_dirname)
 
 
+def batch_loss(model, inst, chunk_size=None):
+    """
+    Average per token loss of the model on a batch of LmInstanceDataset
+    With the full softmax, the output layer runs over chunk_size time steps at a time (all of them if None) and its
+    logits are recomputed in backward, so the full [batch*seqlen X vocab] logits are never held (see sequence_nll)
+    """
+    text_inst, text_lens = inst.text
+    target_inst, target_lens = inst.target
+    if model.uses_adaptive_softmax():
+        return model.sequence_loss(text_inst, text_lens, target_inst, target_lens) #whole sequence at once, batches are sorted by length
+    output, _ = model.encode(text_inst, None, text_lens)
+    output = output.view(text_inst.size(0), text_inst.size(1), -1)
+    nll = sequence_nll(output, target_inst, target_lens, chunk_size=chunk_size, output_layer=model.linear_out)
+    return nll.sum() / target_lens.sum().float()
+
+
 def validation(args, val_batches, model):
     model.eval()
 
@@ -44,22 +63,10 @@ def validation(args, val_batches, model):
         for iteration, inst in enumerate(val_batches): 
             instance = du.lm_send_instance_to(inst, args.device)
 
-            text_inst, text_lens = inst.text
-            target_inst, target_lens = inst.target
-
-            logits = []
-            hidden=None
-            for step in range(text_inst.size(1)):
-                step_inp = text_inst[:, step] #get all instances for this step
-                step_inp = step_inp.unsqueeze(1) #[batch X 1]
-
-                logit_i, hidden = model(step_inp, hidden)
-                logits += [logit_i]
-            logits = torch.stack(logits, dim=1) #[batch, seq_len, vocab]
-
-            loss = masked_cross_entropy(logits, target_inst, target_lens)
+            loss = batch_loss(model, inst, args.loss_chunk_size or None)
             valid_loss+=loss.cpu()
-    valid_loss = valid_loss/(iteration+1)
+    valid_loss, num_batches = distributed.all_reduce_sum(args, [valid_loss, iteration+1]) #each rank only saw its share
+    valid_loss = valid_loss/num_batches
 
     return valid_loss
 
@@ -89,9 +96,13 @@ def train(args):
         model = torch.load(args.load_model, map_location=args.device)
     else:
         logging.info("Creating the Model")
-        model = LM.EventLM(args.event_embed_size, args.rnn_hidden_dim, args.rnn_layers, len(evocab.itos), dropout=args.dropout)
+        model = LM.EventLM(args.event_embed_size, args.rnn_hidden_dim, args.rnn_layers, len(evocab.itos), dropout=args.dropout,
+                           adaptive_cutoffs=args.adaptive_cutoffs, adaptive_div=args.adaptive_div, adaptive_head=[evocab.stoi[EOS_TOK]])
+        if args.adaptive_cutoffs:
+            logging.info("Using adaptive softmax with cutoffs {}".format(args.adaptive_cutoffs))
 
     model = model.to(device=args.device)
+    distributed.broadcast_parameters(args, model)
 
     #create the optimizer
     if args.load_opt:
@@ -113,8 +124,21 @@ def train(args):
     logging.info("Finished Loading Training Dataset {} examples".format(len(train_dataset)))
     logging.info("Finished Loading Valid Dataset {} examples".format(len(valid_dataset)))
 
-    train_batches = BatchIter(train_dataset, args.batch_size, sort_key=lambda x:len(x.text), train=True, repeat=False, shuffle=True, sort_within_batch=True, device=None)
-    valid_batches = BatchIter(valid_dataset, args.batch_size, sort_key=lambda x:len(x.text), train=False, repeat=False, shuffle=False, sort_within_batch=True, device=None)
+    if args.num_workers > 0:
+        train_batches = ExampleBatchPlan(train_dataset, args.batch_size, sort_key=lambda x:len(x.text), train=True, seed=args.seed, batch_class=du.LmTensorBatch)
+        valid_batches = ExampleBatchPlan(valid_dataset, args.batch_size, sort_key=lambda x:len(x.text), train=False, batch_class=du.LmTensorBatch)
+    else:
+        train_batches = BatchIter(train_dataset, args.batch_size, sort_key=lambda x:len(x.text), train=True, repeat=False, shuffle=True, sort_within_batch=True, device=None)
+        valid_batches = BatchIter(valid_dataset, args.batch_size, sort_key=lambda x:len(x.text), train=False, repeat=False, shuffle=False, sort_within_batch=True, device=None)
+
+    #With data parallel training, each rank only gets its share of the batches
+    train_batches = distributed.shard_batches(args, train_batches)
+    valid_batches = distributed.shard_batches(args, valid_batches, drop_last=False)
+
+    if args.num_workers > 0:
+        #Build batches in background processes, they come out already on args.device
+        train_batches = PrefetchBatches(train_batches, args.num_workers, args.prefetch, device=args.device)
+        valid_batches = PrefetchBatches(valid_batches, args.num_workers, args.prefetch, device=args.device)
     train_data_len = len(train_dataset)
     valid_data_len = len(valid_dataset)
 
@@ -123,43 +147,41 @@ def train(args):
     best_valid_loss= float('inf')
     best_epoch = args.epochs 
 
+    telemetry = Telemetry(args.telemetry if distributed.is_main(args) else None, device=args.device)
+
     #MAIN TRAINING LOOP
     for curr_epoch in range(args.epochs):
         prev_losses = []
+        telemetry.start_wait()
         for iteration, inst in enumerate(train_batches): 
+            telemetry.end_wait()
             instance = du.lm_send_instance_to(inst, args.device)
 
-            text_inst, text_lens = inst.text
-            target_inst, target_lens = inst.target
-
             model.train()
             model.zero_grad()
 
-            logits = []
-            hidden=None
-            for step in range(text_inst.size(1)):
-                step_inp = text_inst[:, step] #get all instances for this step
-                step_inp = step_inp.unsqueeze(1) #[batch X 1]
-
-                logit_i, hidden = model(step_inp, hidden)
-                logits += [logit_i]
-            logits = torch.stack(logits, dim=1) #[batch, seq_len, vocab]
-
-            loss = masked_cross_entropy(logits, target_inst, target_lens)
-            loss.backward()
-            torch.nn.utils.clip_grad_norm(model.parameters(), args.clip)
-            optimizer.step() 
+            with telemetry.phase('forward'):
+                loss = batch_loss(model, inst, args.loss_chunk_size or None)
+            with telemetry.phase('backward'):
+                loss.backward()
+                distributed.average_gradients(args, model)
+            with telemetry.phase('optimizer'):
+                torch.nn.utils.clip_grad_norm(model.parameters(), args.clip)
+                optimizer.step() 
 
             prev_losses.append(loss.cpu().data)
             prev_losses = prev_losses[-50:]
+            telemetry.count(inst.text[0].shape[0], *lm_instance_tokens(inst))
 
             if (iteration % args.log_every == 0) and iteration != 0:
                 past_50_avg = sum(prev_losses) / len(prev_losses)
                 logging.info("Epoch/iteration {}/{}, Past 50 Average Loss {}, Best Val {} at Epoch {}".format(curr_epoch, iteration, past_50_avg, 'NA' if best_valid_loss == float('inf') else best_valid_loss, 'NA' if best_epoch == args.epochs else best_epoch))
+                telemetry.write(curr_epoch, iteration, loss=float(past_50_avg))
 
             if (iteration % args.validate_after == 0) and iteration != 0:
                 logging.info("Running Validation at Epoch/iteration {}/{}".format(curr_epoch, iteration))
-                new_valid_loss = validation(args, valid_batches, model)
+                with telemetry.phase('validation'):
+                    new_valid_loss = validation(args, valid_batches, model)
                 logging.info("Validation loss at Epoch/iteration {}/{}: {:.3f} - Best Validation Loss: {:.3f}".format(curr_epoch, iteration, new_valid_loss, best_valid_loss))
                 if new_valid_loss < best_valid_loss:
                     logging.info("New Validation Best...Saving Model Checkpoint")  
@@ -167,12 +189,16 @@ def train(args):
                     best_epoch = curr_epoch
                     #torch.save(model, "{}.epoch_{}.loss_{:.2f}.pt".format(args.save_model, curr_epoch, best_valid_loss))
                     #torch.save(optimizer, "{}.{}.epoch_{}.loss_{:.2f}.pt".format(args.save_model, "optimizer", curr_epoch, best_valid_loss))
-                    torch.save(model, "{}".format(args.save_model))
-                    torch.save(optimizer, "{}_optimizer".format(args.save_model))
+                    if distributed.is_main(args):
+                        torch.save(model, "{}".format(args.save_model))
+                        torch.save(optimizer, "{}_optimizer".format(args.save_model))
+            telemetry.start_wait()
 
         #END OF EPOCH
+        telemetry.end_wait()
         logging.info("End of Epoch {}, Running Validation".format(curr_epoch))
-        new_valid_loss = validation(args, valid_batches, model)
+        with telemetry.phase('validation'):
+            new_valid_loss = validation(args, valid_batches, model)
         logging.info("Validation loss at end of Epoch {}: {:.3f} - Best Validation Loss: {:.3f}".format(curr_epoch, new_valid_loss, best_valid_loss))
         if new_valid_loss < best_valid_loss:
             logging.info("New Validation Best...Saving Model Checkpoint")  
@@ -180,8 +206,9 @@ def train(args):
             best_epoch = curr_epoch
             #torch.save(model, "{}.epoch_{}.loss_{:.2f}.pt".format(args.save_model, curr_epoch, best_valid_loss))
             #torch.save(optimizer, "{}.{}.epoch_{}.loss_{:.2f}.pt".format(args.save_model, "optimizer", curr_epoch, best_valid_loss))
-            torch.save(model, "{}".format(args.save_model))
-            torch.save(optimizer, "{}_optimizer".format(args.save_model))
+            if distributed.is_main(args):
+                torch.save(model, "{}".format(args.save_model))
+                torch.save(optimizer, "{}_optimizer".format(args.save_model))
 
         if curr_epoch - best_epoch >= args.stop_after:
             logging.info("No improvement in {} epochs, terminating at epoch {}...".format(args.stop_after, curr_epoch))
@@ -214,6 +241,16 @@ if __name__ == "__main__":
     parser.add_argument('-save_model', default='model_checkpoint.pt', help="""Model filename""")
     parser.add_argument('--load_model', type=str)
     parser.add_argument('--load_opt', type=str)
+    parser.add_argument('--adaptive_cutoffs', type=int, nargs='+', default=None, help='Use an adaptive softmax output layer with these cluster cutoffs (eg 2000 10000), EOS always goes in the head cluster')
+    parser.add_argument('--adaptive_div', type=float, default=4.0, help='Factor the adaptive softmax shrinks the hidden size by for each tail cluster')
+    parser.add_argument('--loss_chunk_size', type=int, default=8, help='Compute the loss over this many time steps at a time, recomputing the logits in backward, to cap peak memory (0 for the whole sequence in one chunk, ignored with --adaptive_cutoffs)')
+    parser.add_argument('--telemetry', type=str, default=None, help='Append per log interval timings/throughput records (jsonl) to this file')
+    parser.add_argument('--world_size', type=int, default=1, help='Total number of data parallel (gloo) training processes, over all nodes')
+    parser.add_argument('--nprocs', type=int, default=None, help='Number of training processes to launch on this node (default world_size)')
+    parser.add_argument('--node_rank', type=int, default=0, help='Index of this node when training over several nodes')
+    parser.add_argument('--dist_url', type=str, default='tcp://127.0.0.1:23456', help='Address of the rank 0 process for data parallel training')
+    parser.add_argument('--num_workers', type=int, default=0, help='Number of background processes building batches (0 builds them in the training loop)')
+    parser.add_argument('--prefetch', type=int, default=8, help='Maximum number of batches the workers build ahead of training')
 
 
     logging.basicConfig(level=logging.INFO)
@@ -241,7 +278,7 @@ if __name__ == "__main__":
         args.device = torch.device('cpu')
     
 
-    train(args)
+    distributed.launch(train, args)
 
 
 
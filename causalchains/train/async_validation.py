@@ -0,0 +1,149 @@
+########################################
+#   Validation off the training loop
+#   A background (spawned) process holds a cpu copy of the model,
+#   gets snapshots of the weights through shared memory, and sends
+#   back the validation loss; training keeps going meanwhile. The
+#   trainer polls for results and decides on new bests (saving the
+#   snapshot that was validated, not the current weights) when
+#   they arrive.
+#
+#   Also builds a fixed, stratified (by e2) subsample of the
+#   validation data for cheap mid-epoch checks.
+########################################
+import torch
+import torch.multiprocessing as mp
+import random
+import copy
+import queue
+import logging
+import causalchains.utils.data_utils as du
+
+
+def stratified_subsample(labels, size, seed=11):
+    """
+    Indices of a random subsample of (at most) size instances, with each label getting its proportional share
+    (largest remainder rounding, so very rare labels can get none)
+    Params:
+        labels (list) : label of each instance
+    """
+    if size >= len(labels):
+        return list(range(len(labels)))
+    rng = random.Random(seed)
+    strata = {}
+    for idx, label in enumerate(labels):
+        strata.setdefault(label, []).append(idx)
+
+    quotas = dict([(label, size * len(members) / float(len(labels))) for label, members in strata.items()])
+    counts = dict([(label, int(quota)) for label, quota in quotas.items()])
+    leftover = size - sum(counts.values())
+    for label in sorted(strata.keys(), key=lambda l: quotas[l] - counts[l], reverse=True)[:leftover]:
+        counts[label] += 1
+
+    sample = []
+    for label, members in strata.items():
+        sample.extend(rng.sample(members, counts[label]))
+    return sorted(sample)
+
+
+def subsample_batches(source, labels, size, batch_size, seed=11):
+    """
+    Build the batches for a fixed stratified subsample once, so every check sees the same instances
+    Params:
+        source : planned batch source with sort_lengths and batch(indices) (ExampleBatchPlan, MappedBatchIter)
+        labels (list) : e2 of each instance of source
+    Returns:
+        list of batches
+    """
+    indices = stratified_subsample(labels, size, seed)
+    indices.sort(key=lambda i: source.sort_lengths[i], reverse=True) #batch instances of similar length together
+    return [source.batch(indices[i:i+batch_size]) for i in range(0, len(indices), batch_size)]
+
+
+def _validation_worker(validate_fn, model, batch_sets, threads, tasks, results):
+    torch.set_num_threads(threads)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        tag, name, state = task
+        model.load_state_dict(state)
+        results.put((tag, float(validate_fn(model, batch_sets[name]))))
+
+
+def shared_batches(batches):
+    'Read a batch iterable into a list of cpu du.TensorBatch in shared memory, which a spawned process can use without copying'
+    shared = []
+    for batch in batches:
+        batch = batch if isinstance(batch, du.TensorBatch) else du.TensorBatch(batch) #torchtext Batch from BatchIter
+        shared.append(batch.to(torch.device('cpu')).share_memory_())
+    return shared
+
+
+class AsyncValidator(object):
+    """
+    Runs validate_fn(model, batches) on weight snapshots in a background process on the cpu.
+    The process is spawned, not forked, since forking a trainer that already started cuda or
+    OpenMP thread pools is unsafe. The batches and the snapshots get to it through shared memory
+    """
+
+    def __init__(self, validate_fn, model, batch_sets, threads=1):
+        """
+        Params:
+            validate_fn (function) : (model, batches) -> average loss, must be picklable (a module level function, or a functools.partial of one)
+            model : the model being trained
+            batch_sets (dict) : name -> batch iterable, eg. the full validation set and the subsample (read into memory once)
+            threads (int) : torch threads for the worker
+        """
+        ctx = mp.get_context('spawn')
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.model = copy.deepcopy(model).cpu() #only used to save the snapshots that come out best, never given to the worker
+        self.pending = {} #tag -> (info, snapshot)
+        self.next_tag = 0
+        shared_sets = dict([(name, shared_batches(batches)) for name, batches in batch_sets.items()])
+        worker_model = copy.deepcopy(self.model) #sending a cpu model to the worker moves its storages to shared memory, so it needs a copy of its own
+        self.process = ctx.Process(target=_validation_worker, args=(validate_fn, worker_model, shared_sets, threads, self.tasks, self.results), daemon=True)
+        self.process.start()
+
+    def submit(self, name, model, info):
+        """
+        Queue validation of the current weights of model on batch set name
+        Params:
+            info (dict) : returned with the result, eg. epoch and iteration
+        """
+        snapshot = dict([(key, value.detach().cpu().clone().share_memory_()) for key, value in model.state_dict().items()])
+        tag = self.next_tag
+        self.next_tag += 1
+        self.pending[tag] = (info, snapshot)
+        self.tasks.put((tag, name, snapshot))
+
+    def poll(self, block=False):
+        """
+        Returns:
+            list of (info, loss, snapshot) for the validations finished so far, in submission order
+            (all pending ones if block)
+        """
+        finished = []
+        while self.pending:
+            try:
+                tag, loss = self.results.get(timeout=5.0) if block else self.results.get_nowait()
+            except queue.Empty:
+                if not block:
+                    break
+                if not self.process.is_alive():
+                    raise RuntimeError("The validation worker exited unexpectedly")
+                continue
+            info, snapshot = self.pending.pop(tag)
+            finished.append((info, loss, snapshot))
+        return finished
+
+    def snapshot_model(self, snapshot):
+        'A (cpu) copy of the model with the snapshot weights, for saving'
+        self.model.load_state_dict(snapshot)
+        return self.model
+
+    def close(self):
+        self.tasks.put(None)
+        self.process.join(timeout=5.0)
+        if self.process.is_alive():
+            self.process.terminate()
@@ -0,0 +1,59 @@
+########################################
+#   Resumable training checkpoints
+#   Holds the model and optimizer state_dicts, where the trainer
+#   is (epoch, batches done in it, best validation so far) and the
+#   RNG states. The batch order of an epoch only depends on the
+#   seed and the epoch (data_utils.set_epoch), so a restarted job
+#   skips straight to the next batch it had not trained on.
+########################################
+import torch
+import numpy as np
+import random
+import os
+import logging
+from causalchains.utils.score_shards import atomic_save
+
+
+def rng_state():
+    state = {'python': random.getstate(),
+             'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def save_checkpoint(path, model, optimizer, trainer_state):
+    """
+    Params:
+        trainer_state (dict) : epoch, iteration (batches of epoch already trained on), best_valid_loss, best_epoch
+    """
+    checkpoint = {'model': model.state_dict(),
+                  'optimizer': optimizer.state_dict(),
+                  'trainer': trainer_state,
+                  'rng': rng_state()}
+    atomic_save(checkpoint, path)
+    logging.info("Saved checkpoint at Epoch/iteration {}/{}".format(trainer_state['epoch'], trainer_state['iteration']))
+
+
+def load_checkpoint(path, model, optimizer, device=None):
+    """
+    Load the checkpoint at path into model and optimizer (which must be created the same way as the run that saved it)
+    Returns:
+        (dict) the trainer state
+    """
+    checkpoint = torch.load(path, map_location=device)
+    model.load_state_dict(checkpoint['model'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    set_rng_state(checkpoint['rng'])
+    trainer_state = checkpoint['trainer']
+    logging.info("Resuming from {} at Epoch/iteration {}/{}".format(path, trainer_state['epoch'], trainer_state['iteration']))
+    return trainer_state
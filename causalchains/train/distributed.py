@@ -0,0 +1,215 @@
+########################################
+#   Data parallel training over several processes
+#   (gloo backend, so it runs on plain CPU nodes)
+#   Every process builds the same batch order (same seed) and
+#   takes every world_size-th batch, gradients are averaged
+#   with an all reduce after backward, only rank 0 saves.
+#
+#   One node, 8 processes:
+#       python -m causalchains.train.train ... --world_size 8
+#   Two nodes, 8 processes each:
+#       (node 0) ... --world_size 16 --nprocs 8 --node_rank 0 --dist_url tcp://node0:23456
+#       (node 1) ... --world_size 16 --nprocs 8 --node_rank 1 --dist_url tcp://node0:23456
+########################################
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import random
+import numpy as np
+import os
+import logging
+import causalchains.utils.data_utils as du
+
+
+def is_distributed(args):
+    return getattr(args, 'world_size', 1) > 1
+
+
+def is_main(args):
+    'Only the rank 0 process saves models and writes logs/files'
+    return getattr(args, 'rank', 0) == 0
+
+
+def _run(local_rank, train_fn, args):
+    args.rank = args.node_rank * args.nprocs + local_rank
+    logging.basicConfig(level=logging.INFO if args.rank == 0 else logging.WARNING) #fresh process, so this takes effect
+    dist.init_process_group('gloo', init_method=args.dist_url, rank=args.rank, world_size=args.world_size)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.nprocs))
+
+    #Same python/numpy seed everywhere so every rank builds the same batch order, different torch seed for dropout
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed + args.rank)
+    try:
+        train_fn(args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(train_fn, args):
+    """
+    Run train_fn(args) in args.nprocs local processes (or just call it if not distributed)
+    Params:
+        args : needs world_size, nprocs, node_rank, dist_url, seed
+    """
+    if not is_distributed(args):
+        args.rank = 0
+        train_fn(args)
+        return
+    if args.nprocs is None:
+        args.nprocs = args.world_size
+    logging.info("Launching {} processes (world size {}, node rank {})".format(args.nprocs, args.world_size, args.node_rank))
+    mp.spawn(_run, args=(train_fn, args), nprocs=args.nprocs, join=True)
+
+
+def broadcast_parameters(args, model):
+    'Start every rank from rank 0s weights'
+    if not is_distributed(args):
+        return
+    for param in model.state_dict().values():
+        dist.broadcast(param, 0)
+
+
+def _average_sparse(args, param):
+    'Average a sparse (embedding) gradient by gathering every ranks rows, padded to the same size since gloo needs that'
+    if param.grad is None:
+        grad = torch.sparse_coo_tensor(torch.zeros(1, 0, dtype=torch.long, device=param.device), 
+                                       torch.zeros(0, param.size(1), dtype=param.dtype, device=param.device), param.size())
+    else:
+        grad = param.grad.data.coalesce()
+    indices, values = grad._indices(), grad._values() #[1 X nnz], [nnz X dim]
+
+    nnz = torch.LongTensor([values.size(0)])
+    sizes = [torch.zeros_like(nnz) for _ in range(args.world_size)]
+    dist.all_gather(sizes, nnz)
+    max_nnz = max([x.item() for x in sizes])
+
+    padded_indices = indices.new_zeros(indices.size(0), max_nnz)
+    padded_indices[:, :values.size(0)] = indices
+    padded_values = values.new_zeros(max_nnz, values.size(1))
+    padded_values[:values.size(0)] = values
+    all_indices = [torch.zeros_like(padded_indices) for _ in range(args.world_size)]
+    all_values = [torch.zeros_like(padded_values) for _ in range(args.world_size)]
+    dist.all_gather(all_indices, padded_indices)
+    dist.all_gather(all_values, padded_values)
+
+    indices = torch.cat([x[:, :size.item()] for x, size in zip(all_indices, sizes)], dim=1)
+    values = torch.cat([x[:size.item()] for x, size in zip(all_values, sizes)], dim=0) / args.world_size
+    param.grad = torch.sparse_coo_tensor(indices, values, param.size()).coalesce()
+
+
+def average_gradients(args, model):
+    """
+    All reduce the gradients of model, the dense ones as one flat buffer so there is a single round trip per step.
+    Sparse embedding gradients (sparse_optim) get gathered instead, so only the rows used are sent
+    """
+    if not is_distributed(args):
+        return
+    params = [p for p in model.parameters() if p.requires_grad]
+    has_grad = torch.Tensor([0.0 if p.grad is None else 1.0 for p in params])
+    dist.all_reduce(has_grad)
+    params = [p for p, flag in zip(params, has_grad.tolist()) if flag > 0] #no rank has a gradient, leave it None so the optimizer skips it
+
+    sparse_ids = set([id(m.weight) for m in model.modules() if isinstance(m, torch.nn.Embedding) and m.sparse])
+    for param in params:
+        if id(param) in sparse_ids:
+            _average_sparse(args, param)
+
+    params = [p for p in params if id(p) not in sparse_ids]
+    if not params:
+        return
+    grads = [p.grad.data if p.grad is not None else torch.zeros_like(p.data) for p in params] #some other rank has a gradient, no grad here is the same as zero grad
+    flat = torch.cat([g.contiguous().view(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat /= args.world_size
+    offset = 0
+    for p, g in zip(params, grads):
+        numel = g.numel()
+        if p.grad is None:
+            p.grad = flat[offset:offset+numel].view_as(p.data).clone()
+        else:
+            p.grad.data.copy_(flat[offset:offset+numel].view_as(g))
+        offset += numel
+
+
+def all_reduce_sum(args, values):
+    'Sum the list of numbers values across ranks, returns a list of floats'
+    values = [float(x) for x in values]
+    if not is_distributed(args):
+        return values
+    total = torch.Tensor(values).double()
+    dist.all_reduce(total)
+    return total.tolist()
+
+
+class ShardedPlan(object):
+    'This ranks share of a planned batch source (see causalchains.utils.prefetch), with drop_last every rank gets the same number of batches'
+
+    def __init__(self, source, rank, world_size, drop_last=True):
+        self.source = source
+        self.rank = rank
+        self.world_size = world_size
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.skip = 0
+
+    def set_epoch(self, epoch, skip=0, seed=None):
+        self.epoch = epoch
+        self.skip = skip
+
+    def epoch_batches(self, epoch):
+        plan = self.source.epoch_batches(epoch)
+        usable = (len(plan) // self.world_size) * self.world_size if self.drop_last else len(plan) #drop the remainder so no rank waits on an all reduce
+        return plan[self.rank:usable:self.world_size]
+
+    def batch(self, indices):
+        return self.source.batch(indices)
+
+    def __len__(self):
+        return len(self.source) // self.world_size
+
+    def __iter__(self):
+        plan = self.epoch_batches(self.epoch)[self.skip:]
+        self.epoch += 1
+        self.skip = 0
+        for indices in plan:
+            yield self.batch(indices)
+
+
+class ShardedBatches(object):
+    'This ranks share of any batch iterable, takes batch rank out of every world_size (with drop_last, not from an incomplete last group)'
+
+    def __init__(self, batches, rank, world_size, drop_last=True):
+        self.batches = batches
+        self.rank = rank
+        self.world_size = world_size
+        self.drop_last = drop_last
+
+    def __len__(self):
+        return len(self.batches) // self.world_size
+
+    def set_epoch(self, epoch, skip=0, seed=11):
+        du.set_epoch(self.batches, epoch, skip*self.world_size, seed) #skip whole groups
+
+    def __iter__(self):
+        group = []
+        for batch in self.batches:
+            group.append(batch)
+            if len(group) == self.world_size:
+                yield group[self.rank]
+                group = []
+        if not self.drop_last and len(group) > self.rank:
+            yield group[self.rank]
+
+
+def shard_batches(args, batches, drop_last=True):
+    """
+    Wrap batches so this rank only sees its share (planned sources get sharded before any batch is built)
+    Params:
+        drop_last (bool) : Keep the number of batches equal across ranks (needed for training, validation only all reduces at the end)
+    """
+    if not is_distributed(args):
+        return batches
+    if hasattr(batches, 'epoch_batches'):
+        return ShardedPlan(batches, args.rank, args.world_size, drop_last)
+    return ShardedBatches(batches, args.rank, args.world_size, drop_last)
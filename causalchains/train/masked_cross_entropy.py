@@ -4,58 +4,76 @@ import torch
 import torch.nn as nn
 import numpy as np
 import math
-from torch.autograd import Variable
-import torch.nn.functional as functional 
+from torch.utils.checkpoint import checkpoint
 
 
 def _sequence_mask(sequence_length, max_len=None):
+    'Mask [batch X max_len], 1 for the positions before each sequence_length, made on the same device'
     if max_len is None:
-        max_len = sequence_length.data.max()
-    batch_size = sequence_length.size(0)
-    seq_range = torch.arange(0, max_len).long() #changed to arange
-    seq_range_expand = seq_range.unsqueeze(0).expand(batch_size, max_len)
-    seq_range_expand = Variable(seq_range_expand)
-    if sequence_length.is_cuda:
-        seq_range_expand = seq_range_expand.cuda()
-    seq_length_expand = (sequence_length.unsqueeze(1)
-                         .expand_as(seq_range_expand))
-    return seq_range_expand < seq_length_expand
+        max_len = sequence_length.max().item()
+    seq_range = torch.arange(max_len, device=sequence_length.device).unsqueeze(0) #[1 X max_len]
+    return seq_range < sequence_length.unsqueeze(1)
+
+
+def _chunk_nll(logits, target, mask):
+    'Masked NLL of a [batch X chunk len X num_classes] slice of logits, summed over time -> [batch]'
+    # log softmax of the target only: logsumexp - target logit, no separate log prob tensor like log_softmax makes.
+    # logsumexp still keeps its input (the logits) for backward, the memory saving comes from sequence_nll recomputing
+    # each chunk's logits from output_layer in backward instead
+    target_logits = logits.gather(2, target.unsqueeze(2)).squeeze(2)
+    nll = torch.logsumexp(logits, dim=2) - target_logits
+    return nll.masked_fill(mask == 0, 0.0).sum(1)
+
+
+def sequence_nll(logits, target, length, chunk_size=None, output_layer=None):
+    """
+    Negative log likelihood of every sequence in a padded batch
+    Args:
+        logits: FloatTensor (batch, max_len, num_classes) of unnormalized scores, or
+            (batch, max_len, hidden) inputs to output_layer
+        target: LongTensor (batch, max_len) of true classes
+        length: LongTensor (batch,) length of each sequence, positions after it are ignored
+        chunk_size: If given, go over max_len this many steps at a time (default all at once).
+            With output_layer, the logits of each chunk are recomputed during backward instead
+            of kept, so only one chunk of logits is ever alive
+        output_layer: function (hidden -> logits), eg. the model's output nn.Linear
+
+    Returns:
+        FloatTensor (batch,) summed NLL of each sequence (for ranking/perplexity, or sum and divide by length.sum() for the average)
+    """
+    mask = _sequence_mask(length, max_len=target.size(1))
+    if chunk_size is None:
+        chunk_size = target.size(1)
+
+    def chunk_nll(inputs, chunk_target, chunk_mask):
+        return _chunk_nll(output_layer(inputs) if output_layer is not None else inputs, chunk_target, chunk_mask)
+
+    nll = 0.0
+    for start in range(0, target.size(1), chunk_size):
+        chunk = (logits[:, start:start+chunk_size], target[:, start:start+chunk_size], mask[:, start:start+chunk_size])
+        if output_layer is not None and torch.is_grad_enabled() and logits.requires_grad:
+            nll = nll + checkpoint(chunk_nll, *chunk, use_reentrant=False)
+        else:
+            nll = nll + chunk_nll(*chunk)
+    return nll
+
 
 def masked_cross_entropy(logits, target, length, shard=False):
     """
     Args:
-        logits: A Variable containing a FloatTensor of size
+        logits: A FloatTensor of size
             (batch, max_len, num_classes) which contains the
             unnormalized probability for each class.
-        target: A Variable containing a LongTensor of size
+        target: A LongTensor of size
             (batch, max_len) which contains the index of the true
             class for each corresponding step.
-        length: A Variable containing a LongTensor of size (batch,)
+        length: A LongTensor of size (batch,)
             which contains the length of each data in a batch.
 
     Returns:
         loss: An average loss value masked by the length.
     """
-
-    # logits_flat: (batch * max_len, num_classes)
-    logits_flat = logits.view(-1, logits.size(-1))
-    # log_probs_flat: (batch * max_len, num_classes)
-    log_probs_flat = functional.log_softmax(logits_flat, dim=1) #added dim=1
-    #print("log probs flat {}".format(log_probs_flat.size()))
-    # target_flat: (batch * max_len, 1)
-    target_flat = target.view(-1, 1)
-    #print("target flat {}".format(target_flat.size()))
-    # losses_flat: (batch * max_len, 1)
-    losses_flat = -torch.gather(log_probs_flat, dim=1, index=target_flat)
-    # losses: (batch, max_len)
-    losses = losses_flat.view(*target.size())
-    #print("losses {}".format(losses.size))
-    # mask: (batch, max_len)
-    mask = _sequence_mask(sequence_length=length, max_len=target.size(1)) 
-    #print("mask {}".format(mask))
-    losses = losses * mask.float()
-    #print("losses {}".format(losses))
-    loss = losses.sum() 
+    loss = sequence_nll(logits, target, length).sum()
     if shard:
         return loss, length.float().sum() # changed it to return loss and length
     else:
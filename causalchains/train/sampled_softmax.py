@@ -0,0 +1,72 @@
+########################################
+#   Sampled softmax for training the ExpectedOutcome
+#   output layer without computing logits for the whole
+#   event vocab. Validation still uses the full softmax.
+########################################
+import torch
+import torch.nn.functional as F
+import math
+from causalchains.utils.data_utils import PAD_TOK
+
+SAMPLERS = ['unigram', 'log_uniform']
+
+
+def unigram_probs(evocab, power=0.75):
+    'Event frequencies (from evocab.freqs) raised to power and normalized, specials that have no count get a count of 1'
+    counts = torch.Tensor([evocab.freqs.get(x, 0) for x in evocab.itos]).clamp(min=1.0).pow(power)
+    counts[evocab.stoi[PAD_TOK]] = 0.0
+    return counts / counts.sum()
+
+
+def log_uniform_probs(evocab):
+    'Zipfian distribution over event ids, P(k) = log((k+2)/(k+1)) / log(V+1), assumes ids are sorted by frequency (as torchtext does)'
+    ids = torch.arange(len(evocab.itos)).float()
+    probs = (torch.log(ids + 2) - torch.log(ids + 1)) / math.log(len(evocab.itos) + 1)
+    probs[evocab.stoi[PAD_TOK]] = 0.0
+    return probs / probs.sum()
+
+
+class EventSampler(object):
+    'Draws negative events for sampled softmax from a fixed distribution'
+
+    def __init__(self, probs, num_samples, device=None):
+        """
+        Params:
+            probs (Tensor) : [num events] the sampling distribution
+            num_samples (int) : number of events to sample per batch
+        """
+        self.probs = probs.to(device=device)
+        self.num_samples = num_samples
+        self.log_expected = torch.log(self.probs * num_samples + 1e-20) #log of expected number of times each event is sampled
+
+    def sample(self):
+        return torch.multinomial(self.probs, self.num_samples, replacement=True)
+
+
+def sampled_softmax_loss(target_logits, sampled_logits, targets, sampled, sampler):
+    """
+    Cross entropy over the target and the sampled events, with logits corrected by the log expected sample counts
+    (so it is an unbiased-ish stand in for the full softmax cross entropy), sampled events equal to the target are masked out
+    Params:
+        target_logits (Tensor) : [batch] (from ExpectedOutcome.sampled_logits)
+        sampled_logits (Tensor) : [batch X num sampled]
+        targets (Tensor) : [batch] the true events
+        sampled (Tensor) : [num sampled] output of sampler.sample()
+    Returns:
+        mean loss over the batch
+    """
+    target_logits = target_logits - sampler.log_expected[targets]
+    sampled_logits = sampled_logits - sampler.log_expected[sampled].unsqueeze(0)
+    hits = targets.unsqueeze(1) == sampled.unsqueeze(0)
+    sampled_logits = sampled_logits.masked_fill(hits, -float('inf'))
+
+    logits = torch.cat([target_logits.unsqueeze(1), sampled_logits], dim=1) #the target is always class 0
+    return F.cross_entropy(logits, torch.zeros_like(targets))
+
+
+def make_sampler(args, evocab):
+    if args.sampler == 'log_uniform':
+        probs = log_uniform_probs(evocab)
+    else:
+        probs = unigram_probs(evocab, args.sampler_power)
+    return EventSampler(probs, args.sampled_softmax, device=args.device)
@@ -0,0 +1,80 @@
+########################################
+#   Sparse gradients for the embedding tables
+#   With a sparse_* --optimizer, the nn.Embedding layers produce
+#   sparse gradients (just the rows used by the batch). Those go to
+#   SparseAdam (sparse_adam) or Adagrad (sparse_adagrad, which
+#   handles sparse gradients), and every other parameter goes to a
+#   dense Adam. Optimizer time then scales with the batch instead of
+#   the vocabulary size.
+########################################
+import torch
+import torch.nn as nn
+import logging
+
+OPTIMIZERS = ['adam', 'adagrad', 'sgd', 'sparse_adam', 'sparse_adagrad']
+
+
+def use_sparse_embeddings(model):
+    'Switch every nn.Embedding of model to sparse gradients (also works on loaded models)'
+    for module in model.modules():
+        if isinstance(module, nn.Embedding):
+            module.sparse = True
+
+
+def sparse_parameters(model):
+    'Weights of the embeddings of model that produce sparse gradients'
+    return [module.weight for module in model.modules() if isinstance(module, nn.Embedding) and module.sparse]
+
+
+def dense_parameters(model):
+    'Trainable parameters of model with dense gradients (the ones to clip)'
+    sparse_ids = set([id(p) for p in sparse_parameters(model)])
+    return [p for p in model.parameters() if p.requires_grad and id(p) not in sparse_ids]
+
+
+class SplitOptimizer(object):
+    'Several optimizers over disjoint sets of parameters, used like a single one'
+
+    def __init__(self, optimizers):
+        self.optimizers = optimizers
+
+    @property
+    def param_groups(self):
+        return [group for optimizer in self.optimizers for group in optimizer.param_groups]
+
+    def zero_grad(self):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+    def state_dict(self):
+        return {'optimizers': [optimizer.state_dict() for optimizer in self.optimizers]}
+
+    def load_state_dict(self, state_dict):
+        for optimizer, state in zip(self.optimizers, state_dict['optimizers']):
+            optimizer.load_state_dict(state)
+
+
+def make_split_optimizer(model, name, lr):
+    """
+    Params:
+        model : with sparse embeddings already switched on (use_sparse_embeddings)
+        name (str) : sparse_adam or sparse_adagrad
+    Returns:
+        SplitOptimizer, sparse optimizer for the embeddings and Adam for the rest
+    """
+    sparse = [p for p in sparse_parameters(model) if p.requires_grad]
+    dense = dense_parameters(model)
+    optimizers = []
+    if sparse: #torch optimizers refuse empty parameter lists (eg. everything but the last layer frozen)
+        if name == 'sparse_adam':
+            optimizers.append(torch.optim.SparseAdam(sparse, lr=lr))
+        else:
+            optimizers.append(torch.optim.Adagrad(sparse, lr=lr))
+    if dense:
+        optimizers.append(torch.optim.Adam(dense, lr=lr))
+    logging.info("{} for {} embedding tables, Adam for {} other parameters".format('SparseAdam' if name == 'sparse_adam' else 'Adagrad', len(sparse), len(dense)))
+    return SplitOptimizer(optimizers)
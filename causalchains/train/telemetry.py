@@ -0,0 +1,99 @@
+########################################
+#   Training throughput telemetry
+#   Accumulates time spent per phase of the training loop
+#   (waiting on data, forward, backward, optimizer, validation)
+#   and examples/tokens seen, and writes one json line per
+#   logging interval, eg.
+#   {"epoch": 0, "iteration": 500, "interval_sec": 61.2, "data_wait_sec": 20.1, "forward_sec": 18.4, ...,
+#    "examples_per_sec": 261.4, "tokens_per_sec": 9012.5, "padding_ratio": 0.31, "peak_rss_mb": 5120.3}
+########################################
+import torch
+import time
+import json
+import resource
+import sys
+from contextlib import contextmanager
+
+PHASES = ['data_wait', 'forward', 'backward', 'optimizer', 'validation']
+
+
+def peak_rss_mb():
+    'Peak resident memory of this process so far'
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0*1024.0) if sys.platform == 'darwin' else peak / 1024.0 #bytes on mac, kb on linux
+
+
+def instance_tokens(instance):
+    'Returns (real, padded) number of tokens in a batch of InstanceDataset, counting e1_text and allprev'
+    real = instance.e1_text[1].sum().item() + instance.allprev[1].sum().item()
+    padded = instance.e1_text[0].numel() + instance.allprev[0].numel()
+    return real, padded
+
+
+def lm_instance_tokens(instance):
+    'Returns (real, padded) number of tokens in a batch of LmInstanceDataset'
+    return instance.text[1].sum().item(), instance.text[0].numel()
+
+
+class Telemetry(object):
+    'Does nothing (but keep time) if path is None'
+
+    def __init__(self, path, device=None):
+        """
+        Params:
+            path (str) : jsonl file to append records to
+            device : the training device, cuda is synchronized at the end of each phase so the timings are real
+        """
+        self.out = open(path, 'a') if path else None
+        self.sync = device is not None and torch.device(device).type == 'cuda'
+        self.wait_start = None
+        self.reset()
+
+    def reset(self):
+        self.times = dict([(name, 0.0) for name in PHASES])
+        self.examples = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.interval_start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync:
+                torch.cuda.synchronize()
+            self.times[name] += time.perf_counter() - start
+
+    def start_wait(self):
+        'Call right before asking the batch iterator for the next batch'
+        self.wait_start = time.perf_counter()
+
+    def end_wait(self):
+        'Call as soon as the next batch arrives'
+        if self.wait_start is not None:
+            self.times['data_wait'] += time.perf_counter() - self.wait_start
+            self.wait_start = None
+
+    def count(self, examples, tokens, padded_tokens):
+        self.examples += examples
+        self.tokens += tokens
+        self.padded_tokens += padded_tokens
+
+    def write(self, epoch, iteration, **extra):
+        'Write the record for the interval since the last write, and start a new one'
+        if self.out is not None:
+            elapsed = time.perf_counter() - self.interval_start
+            record = {'time': time.time(), 'epoch': epoch, 'iteration': iteration, 'interval_sec': elapsed}
+            for name in PHASES:
+                record['{}_sec'.format(name)] = self.times[name]
+            record['examples'] = self.examples
+            record['examples_per_sec'] = self.examples / elapsed if elapsed > 0 else 0.0
+            record['tokens_per_sec'] = self.tokens / elapsed if elapsed > 0 else 0.0
+            record['padding_ratio'] = 1.0 - float(self.tokens) / self.padded_tokens if self.padded_tokens > 0 else 0.0
+            record['peak_rss_mb'] = peak_rss_mb()
+            record.update(extra)
+            self.out.write(json.dumps(record) + "\n")
+            self.out.flush()
+        self.reset()
@@ -8,6 +8,8 @@ import math
 import torch.nn.functional as F
 import causalchains.utils.data_utils as du
 from causalchains.utils.data_utils import PAD_TOK, EOS_TOK, SOS_TOK
+import causalchains.utils.score_shards as shards
+import causalchains.utils.score_matrix as score_matrix
 import causalchains.models.estimator_model as estimators
 import time
 from torchtext.vocab import GloVe
@@ -18,6 +20,7 @@ import sys
 import os
 import logging
 import json
+from collections import OrderedDict
 
 from causalchains.models.estimator_model import EXP_OUTCOME_COMPONENT, PROPENSITY_COMPONENT
 
@@ -29,101 +32,369 @@ def prediction_topk(model_outputs, evocab, k=5):
     return predicted
 
 
-def intervention_dist(dset, batches, model, e1, evocab, device=None, batch_size=1024):
-
+def intervention_dist(batches, model, e1, evocab, num_examples, device=None):
+    """
+    Params:
+        batches (list) : list of data_utils.TensorBatch
+        e1 (str) : string form of the event to intervene with
+        num_examples (int) : total number of examples in batches
+    Returns:
+        tensor[vocab_len]
+    """
+    e1_idx = evocab.stoi[e1]
     accum = torch.zeros(len(evocab.itos))
     with torch.no_grad():
         for batch in batches:
-            for example in batch: #Intervene on all instances in the batch
-                example.allprev = example.e1prev_intext + [e1]
-                example.e1 = e1 #e1 is a string
-            output=model(dset.example_to_batch(batch, device=device, multiple=True))
+            output=model(batch.intervene(e1_idx).to(device)) #Intervene on all instances in the batch
             output = output[EXP_OUTCOME_COMPONENT] #logits, batch X dim
             sm_output = F.softmax(output, dim=1)
             accum += torch.sum(sm_output, dim=0).cpu()
 
-    final = accum / len(dset.examples)
+    final = accum / num_examples
     return final #tensor[vocab_len]
 
-def normalized_scores_matrix(args, model, batch_size=1024):
-    evocab = du.load_vocab(args.evocab)
-    tvocab = du.load_vocab(args.tvocab)
-    outfile = args.outfile
+
+def intervention_dists(batches, model, e1s, evocab, num_examples, device=None, e1_chunk=8):
+    """
+    Same as intervention_dist, but for many e1s at once. Each batch's context (text, previous events) is encoded
+    a single time with ExpectedOutcome.encode_context, and each e1's contribution is then added to the (linear) output layer,
+    e1_chunk events at a time
+    Params:
+        batches (list) : list of data_utils.TensorBatch, sorted by decreasing e1prev_intext length
+        e1s (list) : string form of the events to intervene with
+        num_examples (int) : total number of examples in batches
+        e1_chunk (int) : number of events to intervene with at a time, memory is [e1_chunk X batch size X vocab]
+    Returns:
+        tensor[len(e1s), vocab_len]
+    """
+    expected_outcome = model.expected_outcome
+    e1_idxs = torch.LongTensor([evocab.stoi[e1] for e1 in e1s]).to(device=device)
+    accum = torch.zeros(len(e1s), len(evocab.itos))
+    with torch.no_grad():
+        for batch in batches:
+            context = expected_outcome.encode_context(batch.to(device))
+            for start in range(0, len(e1s), e1_chunk):
+                output = expected_outcome.intervened_logits(context, e1_idxs[start:start+e1_chunk]) #logits, e1_chunk X batch X dim
+                sm_output = F.softmax(output, dim=2)
+                accum[start:start+e1_chunk] += torch.sum(sm_output, dim=1).cpu()
+
+    final = accum / num_examples
+    return final
+
+
+def auto_e1_chunk(batch_size, vocab_size, mem_mb):
+    'Largest e1_chunk whose logits and softmax (each a float [e1_chunk X batch size X vocab]) fit in mem_mb megabytes'
+    return max(1, int(mem_mb * 2**20 // (2 * 4 * batch_size * vocab_size)))
+
+
+def adaptive_intervention_dists(batches, model, e1s, evocab, device=None, e1_chunk=8, topk=10, tol=0.05, growth=2.0, seed=11):
+    """
+    Monte Carlo version of intervention_dists, instead of averaging over every example, average over a random sample of
+    batches that grows (by a factor of growth) each round. An event stops being sampled once its top k e2s are the same
+    as the previous round and each of their estimated probabilities has a relative standard error below tol
+    Params:
+        batches (list) : list of data_utils.TensorBatch, sorted by decreasing e1prev_intext length
+        e1s (list) : string form of the events to intervene with
+        topk (int) : number of top e2s that need to be stable
+        tol (float) : max relative standard error (stderr / estimate) for the top k e2s
+        seed (int) : seed for the order batches are sampled in
+    Returns:
+        tensor[len(e1s), vocab_len]
+    """
+    expected_outcome = model.expected_outcome
+    e1_idxs = torch.LongTensor([evocab.stoi[e1] for e1 in e1s]).to(device=device)
+    accum = torch.zeros(len(e1s), len(evocab.itos))
+    accum_sq = torch.zeros(len(e1s), len(evocab.itos)) #for the running variance
+    seen = torch.zeros(len(e1s))
+    prev_top = [None]*len(e1s)
+    active = list(range(len(e1s)))
+
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    order = torch.randperm(len(batches), generator=generator).tolist()
+    pos = 0
+    round_size = 1
+    with torch.no_grad():
+        while active and pos < len(order):
+            active_idxs = e1_idxs[torch.LongTensor(active).to(device=e1_idxs.device)]
+            for batch_idx in order[pos:pos+round_size]:
+                context = expected_outcome.encode_context(batches[batch_idx].to(device))
+                for start in range(0, len(active), e1_chunk):
+                    rows = active[start:start+e1_chunk]
+                    output = expected_outcome.intervened_logits(context, active_idxs[start:start+e1_chunk])
+                    sm_output = F.softmax(output, dim=2) #e1_chunk X batch X dim
+                    accum[rows] += torch.sum(sm_output, dim=1).cpu()
+                    accum_sq[rows] += torch.sum(sm_output*sm_output, dim=1).cpu()
+                seen[active] += len(batches[batch_idx])
+
+            pos += round_size
+            round_size = int(math.ceil(round_size*growth))
+
+            still_active = []
+            for row in active:
+                mean = accum[row] / seen[row]
+                top_vals, top = mean.topk(topk)
+                variance = (accum_sq[row, top] / seen[row] - top_vals*top_vals).clamp(min=0.0)
+                rel_stderr = torch.sqrt(variance / seen[row]) / top_vals
+                converged = prev_top[row] is not None and torch.equal(top, prev_top[row]) and rel_stderr.max().item() < tol
+                prev_top[row] = top
+                if not converged:
+                    still_active.append(row)
+            logging.info("Sampled {} of {} batches, {} of {} events converged".format(min(pos, len(order)), len(order), len(e1s) - len(still_active), len(e1s)))
+            active = still_active
+
+    final = accum / seen.unsqueeze(dim=1)
+    return final
+
+
+def compute_interventions(args, batches, model, e1s, evocab, device=None, e1_chunk=8):
+    """
+    Return the (unnormalized) intervention distributions for every event in e1s, tensor[len(e1s), vocab_len]
+    using intervention_dist, intervention_dists or adaptive_intervention_dists depending on args
+    Params:
+        batches (list) : output of load_intervention_data
+    """
+    num_examples = sum([len(batch) for batch in batches])
+    if args.no_factorize:
+        interven_dists = []
+
+        for e1 in e1s:
+            logging.info("Computing Intervention for Event {}, {}".format(evocab.stoi[e1], e1))
+            interven_e1 = intervention_dist(batches, model, e1, evocab, num_examples, device=device)
+            interven_dists.append(interven_e1)
+
+        return torch.stack(interven_dists, dim=0)
+    elif args.adaptive:
+        return adaptive_intervention_dists(batches, model, e1s, evocab, device=device, e1_chunk=e1_chunk,
+                                           topk=args.adaptive_topk, tol=args.adaptive_tol, growth=args.adaptive_growth, seed=args.seed)
+    else:
+        logging.info("Computing Interventions for {} Events, {} at a time".format(len(e1s), e1_chunk))
+        return intervention_dists(batches, model, e1s, evocab, num_examples, device=device, e1_chunk=e1_chunk)
+
+
+def load_intervention_data(args, model, evocab, tvocab, batch_size=1024):
+    """
+    Load args.data and numericalize/pad it a single time, interventions are then just index writes (TensorBatch.intervene)
+    Returns:
+        list of data_utils.TensorBatch, each sorted by decreasing e1prev_intext length
+    """
     min_size = model.text_encoder.largest_ngram_size #Add extra pads if text size smaller than largest CNN kernel size
     dset= du.InstanceDataset(args.data, evocab, tvocab, min_size=min_size) 
     batches = [sorted(dset.examples[x:x+batch_size], reverse=True, key=lambda ex: len(ex.e1prev_intext)) for x in range(0, len(dset.examples), batch_size)]
+    return [du.TensorBatch(dset.example_to_batch(batch, multiple=True)) for batch in batches]
+
+
+_worker = {} #State for each process in the parallel pool, set by _init_worker
+
+def _init_worker(args, batches, threads, e1_chunk):
+    torch.set_num_threads(threads)
+    model = torch.load(args.model, map_location=torch.device('cpu'))
+    model.eval()
+    _worker['args'] = args
+    _worker['model'] = model
+    _worker['evocab'] = du.load_vocab(args.evocab)
+    _worker['batches'] = batches
+    _worker['e1_chunk'] = e1_chunk
+
+
+def _worker_shard(task):
+    shard_idx, e1s = task
+    dists = compute_interventions(_worker['args'], _worker['batches'], _worker['model'], e1s, _worker['evocab'],
+                                  device=torch.device('cpu'), e1_chunk=_worker['e1_chunk'])
+    return shard_idx, dists
+
+
+def run_shards(args, batches, model, manifest, todo, evocab, e1_chunk=8):
+    """
+    Compute the intervention distributions for every shard in todo, yields (shard idx, tensor[shard rows, vocab_len])
+    as each shard finishes. With args.workers > 1, shards are spread over a pool of (cpu) processes, each loads the model
+    once and reads the batches from shared memory
+    """
+    if args.workers > 1:
+        threads = args.threads_per_worker if args.threads_per_worker > 0 else max(1, os.cpu_count() // args.workers)
+        logging.info("Running {} workers with {} threads each".format(args.workers, threads))
+        for batch in batches:
+            batch.share_memory_()
+
+        tasks = []
+        for shard_idx in todo:
+            start, end = shards.shard_bounds(manifest, shard_idx)
+            tasks.append((shard_idx, manifest['events'][start:end]))
+
+        pool = torch.multiprocessing.get_context('spawn').Pool(args.workers, initializer=_init_worker,
+                                                                initargs=(args, batches, threads, e1_chunk))
+        try:
+            for shard_idx, shard_dists in pool.imap_unordered(_worker_shard, tasks):
+                logging.info("Finished shard {}".format(shard_idx))
+                yield shard_idx, shard_dists
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for shard_idx in todo:
+            start, end = shards.shard_bounds(manifest, shard_idx)
+            logging.info("Computing shard {}, events {} to {}".format(shard_idx, start, end))
+            yield shard_idx, compute_interventions(args, batches, model, manifest['events'][start:end], evocab, device=args.device, e1_chunk=e1_chunk)
+
+
+def write_scores(args, scores, row_events, col_events, kind, normalizer=None):
+    """
+    Save the score matrix to args.outfile, and the sparse top k index if args.topk is set
+    Params:
+        normalizer (Tensor) : [num e2] column sums the scores were normalized by, saved so the matrix can be updated later
+    """
+    metadata = {'kind': kind, 'model': args.model}
+    if normalizer is not None:
+        metadata['normalizer'] = normalizer.tolist()
+    score_matrix.save_score_matrix(args.outfile, scores, row_events, col_events, dtype=args.score_dtype, metadata=metadata)
+    if args.topk > 0:
+        topk_outfile = args.topk_outfile if args.topk_outfile else "{}.topk.npz".format(args.outfile)
+        logging.info("Writing top {} index to {}".format(args.topk, topk_outfile))
+        index = score_matrix.build_topk_index(score_matrix.load_score_matrix(args.outfile), args.topk)
+        score_matrix.save_topk_index(topk_outfile, index)
+
+
+def normalized_scores_matrix(args, model, batch_size=1024, e1_chunk=8):
+    evocab = du.load_vocab(args.evocab)
+    tvocab = du.load_vocab(args.tvocab)
+    outfile = args.outfile
+    if e1_chunk <= 0:
+        e1_chunk = auto_e1_chunk(batch_size, len(evocab.itos), args.intervention_mb)
 
     events = evocab.itos
    # so_events = [x for x in events if len(x.split('->'))==2 and x.split('->')[1] in ['nsubj', 'dobj', 'iobj']]
     so_events = events
     print("USING ALL")
 
-    so_events_itos = list(enumerate(so_events))
-    so_events_stoi = dict([(x[1], x[0]) for x in so_events_itos])
-
-    interven_dists = []
-
-    for i, e1 in so_events_itos:
-        logging.info("Computing Intervention for Event {}, {}".format(i, e1))
-        interven_e1 = intervention_dist(dset, batches, model, e1, evocab, device=args.device)
-        interven_dists.append(interven_e1)
+    if args.shard_dir is None:
+        shard_size = args.shard_size if args.workers > 1 else len(so_events) #a single process can do everything in one go
+        manifest = shards.plan_shards(so_events, shard_size, len(evocab.itos))
+        todo = list(range(manifest['num_shards']))
+    else:
+        manifest = shards.load_manifest(args.shard_dir, so_events, args.shard_size, len(evocab.itos))
+        done = shards.completed_shards(args.shard_dir, manifest)
+        todo = [i for i in range(manifest['num_shards']) if i % args.num_jobs == args.job_id and i not in done]
+        logging.info("{} of {} shards already done, {} left for job {}".format(len(done), manifest['num_shards'], len(todo), args.job_id))
+
+    finished = {}
+    if todo:
+        batches = load_intervention_data(args, model, evocab, tvocab, batch_size=batch_size)
+        for shard_idx, shard_dists in run_shards(args, batches, model, manifest, todo, evocab, e1_chunk=e1_chunk):
+            if args.shard_dir is None:
+                finished[shard_idx] = shard_dists
+            else:
+                shards.write_shard(args.shard_dir, shard_idx, shard_dists)
+
+    if args.shard_dir is None:
+        interven_dists = torch.cat([finished[i] for i in range(manifest['num_shards'])], dim=0)
+    else:
+        if len(shards.completed_shards(args.shard_dir, manifest)) < manifest['num_shards']:
+            logging.info("Shards from other jobs are still missing, rerun once they finish to merge them")
+            return
+        logging.info("All shards done, merging")
+        interven_dists = shards.merge_shards(args.shard_dir, manifest)
+
+    normalizer = torch.sum(interven_dists, dim=0)
+    interven_dists = interven_dists / normalizer.unsqueeze(dim=0) #so_events len X evocab len
+    write_scores(args, interven_dists, so_events, evocab.itos, 'intervention', normalizer=normalizer)
+
+
+def update_scores_matrix(args, model, batch_size=1024, e1_chunk=8):
+    """
+    Update an existing score matrix (args.update_scores) by recomputing only the rows of the events listed in
+    args.update_events (one per line), events not already in the matrix are added as new rows. The old rows are 
+    unnormalized with the column normalizer saved with the matrix, so only the changed rows need to be recomputed.
+
+    The event vocab (the columns) must be the same one the matrix was computed with: each row is a softmax over 
+    every e2, so adding events to the vocab changes every entry of every row, and getting even just the new columns 
+    of an old row takes a full run of the model for that e1. With a changed vocab, recompute from scratch.
+    New e1s that are already in the vocab can be added as rows.
+    """
+    evocab = du.load_vocab(args.evocab)
+    tvocab = du.load_vocab(args.tvocab)
+    if e1_chunk <= 0:
+        e1_chunk = auto_e1_chunk(batch_size, len(evocab.itos), args.intervention_mb)
+
+    old_scores = score_matrix.load_score_matrix(args.update_scores)
+    if 'normalizer' not in old_scores.metadata:
+        raise ValueError("{} has no saved normalizer, it has to be recomputed from scratch".format(args.update_scores))
+    if old_scores.col_events is not None and old_scores.col_events != evocab.itos:
+        raise ValueError("The event vocab changed since {} was computed, every row needs new columns, recompute from scratch".format(args.update_scores))
+
+    with open(args.update_events, 'r') as fi:
+        update_events = [x.strip() for x in fi if x.strip()]
+    update_events = list(OrderedDict.fromkeys(update_events)) #drop repeats, keep order
+    if not update_events:
+        raise ValueError("No events to update in {}".format(args.update_events))
+    missing = [x for x in update_events if x not in evocab.stoi]
+    if missing:
+        raise ValueError("Events not in the event vocab: {}".format(missing))
+    logging.info("Updating {} events ({} new)".format(len(update_events), len([x for x in update_events if x not in old_scores.row_stoi])))
+
+    shard_size = args.shard_size if args.workers > 1 else len(update_events)
+    manifest = shards.plan_shards(update_events, shard_size, len(evocab.itos))
+    batches = load_intervention_data(args, model, evocab, tvocab, batch_size=batch_size)
+    finished = dict(run_shards(args, batches, model, manifest, list(range(manifest['num_shards'])), evocab, e1_chunk=e1_chunk))
+    new_rows = torch.cat([finished[i] for i in range(manifest['num_shards'])], dim=0)
+
+    normalizer = torch.Tensor(old_scores.metadata['normalizer'])
+    scores = old_scores.dense() * normalizer.unsqueeze(dim=0) #back to unnormalized
+    row_events = list(old_scores.row_events)
+    new_normalizer = normalizer + torch.sum(new_rows, dim=0)
+    added = []
+    for i, e1 in enumerate(update_events):
+        if e1 in old_scores.row_stoi:
+            new_normalizer -= scores[old_scores.row_stoi[e1]]
+            scores[old_scores.row_stoi[e1]] = new_rows[i]
+        else:
+            added.append(i)
+            row_events.append(e1)
+    if added:
+        scores = torch.cat([scores, new_rows[torch.LongTensor(added)]], dim=0)
 
-    interven_dists = torch.stack(interven_dists, dim=0)
-    normalizer = torch.sum(interven_dists, dim=0).unsqueeze(dim=0)
-    interven_dists = interven_dists / normalizer
-    interven_dists = interven_dists.tolist() #so_events_itos len X evocab len
-    output = (interven_dists, so_events_itos, so_events_stoi)
-    with open(outfile, 'wb') as fi:
-        pickle.dump(output, fi)
+    scores = scores / new_normalizer.unsqueeze(dim=0)
+    write_scores(args, scores, row_events, evocab.itos, 'intervention', normalizer=new_normalizer)
 
 
-def normalized_scores_matrix_lm(args, model):
+def normalized_scores_matrix_lm(args, model, chunk_size=4096):
+    """
+    Score every (subject/object) e1, e2 pair by the LM joint log probability log P(e1 | <sos>) + log P(e2 | <sos>, e1)
+    All e1s are run through the LM in batches of chunk_size, each starting from the <sos> hidden state
+    """
     evocab = du.load_vocab(args.evocab)
     evocab = du.convert_to_lm_vocab(evocab)
     outfile = args.outfile
 
     events = evocab.itos
     so_events = [x for x in events if len(x.split('->'))==2 and x.split('->')[1] in ['nsubj', 'dobj', 'iobj']]
-
-    so_events_itos = list(enumerate(so_events))
-    so_events_stoi = dict([(x[1], x[0]) for x in so_events_itos])
+    so_idxs = torch.LongTensor([evocab.stoi[x] for x in so_events]).to(device=args.device)
 
     dists = []
-
-    #Get e1 probabilities
-    text_inst= torch.LongTensor([evocab.stoi[SOS_TOK]]) #seqlen tensor]
-    
-    hidden=None
-    logits = None
     with torch.no_grad():
-        step_inp = text_inst[0]
-        step_inp = step_inp.unsqueeze(0).unsqueeze(0) #[1 X 1]
-
-        e1_logits, sos_hidden = model(step_inp, hidden)
-        e1_probs = F.softmax(e1_logits, dim=1).squeeze(0) #[vocab] size
-
-        e1_probs = torch.Tensor([x.item() for i, x in enumerate(e1_probs) if evocab.itos[i] in so_events])
-        assert e1_probs.shape[0] == len(so_events)
-        e1_probs = e1_probs.unsqueeze(dim=1) #[so_vocab, 1]
-
-        for i, e1 in so_events_itos:
-            logging.info("Computing e2 probs for for e1: {}, {}".format(i, e1))
-
-            step_inp = torch.LongTensor([[evocab.stoi[e1]]])
-            e2_logits, _ = model(step_inp, sos_hidden)
-            e2_probs = F.softmax(e2_logits, dim=1).squeeze(0)
-            dists.append(e2_probs)
-
-    dists = torch.stack(dists, dim=0) #[so_vocab, evocabsize]
-    joint_dists = torch.log(dists) + torch.log(e1_probs)
-    joint_dists = joint_dists.tolist()
-    output = (joint_dists, so_events_itos, so_events_stoi)
-    with open(outfile, 'wb') as fi:
-        pickle.dump(output, fi)
-
-
-def eval_copa_proto(lines, scores, stoi, evocab):
-    scores = torch.Tensor(scores)
+        #Get e1 probabilities
+        step_inp = torch.LongTensor([[evocab.stoi[SOS_TOK]]]).to(device=args.device) #[1 X 1]
+        e1_logits, sos_hidden = model(step_inp, None)
+        e1_log_probs = F.log_softmax(e1_logits, dim=1).squeeze(0)[so_idxs] #[so_vocab]
+        e1_log_probs = e1_log_probs.unsqueeze(dim=1).cpu() #[so_vocab, 1]
+
+        for start in range(0, len(so_events), chunk_size):
+            logging.info("Computing e2 probs for e1s {} to {} of {}".format(start, min(start+chunk_size, len(so_events)), len(so_events)))
+            step_inp = so_idxs[start:start+chunk_size].unsqueeze(dim=1) #[chunk X 1]
+            hidden = sos_hidden.expand(sos_hidden.shape[0], step_inp.shape[0], sos_hidden.shape[2]).contiguous()
+            e2_logits, _ = model(step_inp, hidden)
+            dists.append(F.log_softmax(e2_logits, dim=1).cpu())
+
+    dists = torch.cat(dists, dim=0) #[so_vocab, evocabsize]
+    joint_dists = dists + e1_log_probs
+    write_scores(args, joint_dists, so_events, evocab.itos, 'lm_joint')
+
+
+def eval_copa_proto(lines, scores, evocab):
+    """
+    Params:
+        scores (score_matrix.ScoreMatrix) : output of normalized_scores_matrix
+    """
+    stoi = scores.row_stoi
     hits = []
     for line in lines:
         copa_line = json.loads(line)
@@ -137,7 +408,7 @@ def eval_copa_proto(lines, scores, stoi, evocab):
         #if asks_for == 'cause' and premise_e1 in evocab.stoi and a1_e1 in stoi and a2_e1 in stoi:
         if premise_e1 in evocab.stoi and a1_e1 in stoi and a2_e1 in stoi:
         #if asks_for == 'cause' and premise_e1 in evocab.stoi and a1_e1 in stoi and a2_e1 in stoi and premise_e1 in evocab.itos[100:] and a1_e1 in evocab.itos[100:] and a2_e1 in evocab.itos[100:]:
-            premise_scores = scores[:, evocab.stoi[premise_e1]] #[itos size]
+            premise_scores = scores.column(evocab.stoi[premise_e1]) #[itos size]
             a1_score = premise_scores[stoi[a1_e1]]
             a2_score = premise_scores[stoi[a2_e1]]
 
@@ -161,6 +432,27 @@ if __name__ == "__main__":
     parser.add_argument('--copa', action='store_true')
     parser.add_argument('--scores', type=str)
     parser.add_argument('--lm', action='store_true')
+    parser.add_argument('--score_dtype', type=str, default='float32', help='float32 or float16, dtype the score matrix is saved with')
+    parser.add_argument('--topk', type=int, default=0, help='Also write a sparse index of the top k causes of each e2 and effects of each e1')
+    parser.add_argument('--topk_outfile', type=str, default=None, help='Where to write the --topk index (default is outfile.topk.npz)')
+    parser.add_argument('--batch_size', type=int, default=1024)
+    parser.add_argument('--lm_chunk', type=int, default=4096, help='With --lm, number of e1s to run through the LM at once')
+    parser.add_argument('--e1_chunk', type=int, default=0, help='Number of events to intervene with at once, trades memory for speed (0 picks the largest that fits in --intervention_mb)')
+    parser.add_argument('--intervention_mb', type=int, default=1024, help='With --e1_chunk 0, memory (per worker) for the [e1_chunk X batch size X vocab] logits and softmax')
+    parser.add_argument('--no_factorize', action='store_true', help='Rerun the whole estimator for every intervention (slow, for checking)')
+    parser.add_argument('--shard_dir', type=str, default=None, help='Write finished blocks of rows here, rerunning skips finished blocks and merges once all are done')
+    parser.add_argument('--shard_size', type=int, default=256, help='Number of events (rows) per shard')
+    parser.add_argument('--job_id', type=int, default=0, help='With --shard_dir, only compute shards where shard index %% num_jobs == job_id')
+    parser.add_argument('--num_jobs', type=int, default=1)
+    parser.add_argument('--update_scores', type=str, default=None, help='Existing score matrix to update with --update_events, instead of computing from scratch')
+    parser.add_argument('--update_events', type=str, default=None, help='File with the events (one per line) that are new or changed, the event vocab must not have changed since the matrix was computed')
+    parser.add_argument('--workers', type=int, default=1, help='Number of (cpu) processes to split the events over')
+    parser.add_argument('--adaptive', action='store_true', help='Estimate each intervention from a growing random sample of the data, stopping once it converges')
+    parser.add_argument('--adaptive_topk', type=int, default=10, help='With --adaptive, the top k e2s that must be stable')
+    parser.add_argument('--adaptive_tol', type=float, default=0.05, help='With --adaptive, max relative standard error of the top k e2 probabilities')
+    parser.add_argument('--adaptive_growth', type=float, default=2.0, help='With --adaptive, factor the number of sampled batches grows by each round')
+    parser.add_argument('--seed', type=int, default=11, help='random seed')
+    parser.add_argument('--threads_per_worker', type=int, default=0, help='Torch threads for each worker, 0 splits the cores evenly')
 
     logging.basicConfig(level=logging.INFO)
     args = parser.parse_args()
@@ -185,22 +477,26 @@ if __name__ == "__main__":
     if args.copa:
         with open(args.data, 'r') as infi:
             lines = infi.readlines()
-        with open(args.scores, 'rb') as scoresfi:
-            scores, itos, stoi = pickle.load(scoresfi)
+        scores = score_matrix.load_score_matrix(args.scores)
 
         evocab = du.load_vocab(args.evocab)
 
-        eval_copa_proto(lines, scores, stoi, evocab)
+        eval_copa_proto(lines, scores, evocab)
+    elif args.update_scores:
+        model = torch.load(args.model, map_location=args.device)
+        model.eval()
+
+        update_scores_matrix(args, model, batch_size=args.batch_size, e1_chunk=args.e1_chunk)
     elif args.lm:
         model = torch.load(args.model, map_location=args.device)
         model.eval()
 
-        normalized_scores_matrix_lm(args, model)
+        normalized_scores_matrix_lm(args, model, chunk_size=args.lm_chunk)
     else:
         model = torch.load(args.model, map_location=args.device)
         model.eval()
 
-        normalized_scores_matrix(args, model)
+        normalized_scores_matrix(args, model, batch_size=args.batch_size, e1_chunk=args.e1_chunk)
 
     
 
@@ -13,10 +13,20 @@ import torch.nn.functional as F
 import causalchains.utils.data_utils as du
 from causalchains.utils.data_utils import PAD_TOK
 import causalchains.models.estimator_model as estimators
+from causalchains.utils.instance_cache import MappedInstanceDataset, MappedBatchIter, TokenBudgetPlan
+from causalchains.utils.stream_data import StreamingInstanceBatches, expand_shards
+from causalchains.utils.prefetch import PrefetchBatches, ExampleBatchPlan
+from causalchains.train.sampled_softmax import sampled_softmax_loss, make_sampler, SAMPLERS
+import causalchains.train.distributed as distributed
+import causalchains.train.checkpoint as checkpoint
+from causalchains.train.telemetry import Telemetry, instance_tokens
+from causalchains.train.async_validation import AsyncValidator, subsample_batches
+from causalchains.train.sparse_optim import OPTIMIZERS, use_sparse_embeddings, dense_parameters, make_split_optimizer
 import time
-from torchtext.vocab import GloVe
 import pickle
 import gc
+import copy
+import functools
 import glob
 import sys
 import os
@@ -56,10 +66,28 @@ def validation(args, val_batches, model, loss_func):
 
             valid_loss += loss*new_instances #since loss is averaged over batch
   
+    valid_loss, instances_seen = distributed.all_reduce_sum(args, [valid_loss, instances_seen]) #each rank only saw its share
     valid_loss = valid_loss/instances_seen  
     return valid_loss
 
 
+def snapshot_validation(args, loss_func, model, batches):
+    'validation() in the argument order AsyncValidator calls it with'
+    return validation(args, batches, model, loss_func)
+
+
+def token_budget_source(args, dataset, min_size, train=True):
+    'Batches of up to args.max_tokens padded e1_text + allprev tokens over an InstanceDataset or MappedInstanceDataset'
+    if isinstance(dataset, MappedInstanceDataset):
+        source = MappedBatchIter(dataset, args.batch_size, train=train, seed=args.seed)
+        text_lengths, prev_lengths = dataset.lengths('e1_text'), dataset.lengths('allprev')
+    else:
+        source = ExampleBatchPlan(dataset, args.batch_size, sort_key=lambda x:len(x.allprev), train=train, seed=args.seed)
+        text_lengths = np.array([len(x.e1_text) for x in dataset.examples])
+        prev_lengths = np.array([len(x.allprev) for x in dataset.examples])
+    return TokenBudgetPlan(source, text_lengths, prev_lengths, args.max_tokens, min_size=min_size, train=train, seed=args.seed)
+
+
 def train(args):
     """
     Train the model in the ol' fashioned way, just like grandma used to
@@ -74,9 +102,7 @@ def train(args):
     logging.info("Text Vocab Loaded, Size {}".format(len(tvocab.stoi.keys())))
 
     if args.use_pretrained:
-        pretrained = GloVe(name='6B', dim=args.text_embed_size, unk_init=torch.Tensor.normal_)
-        tvocab = du.load_vectors(pretrained)
-        logging.info("Loaded Pretrained Word Embeddings")
+        assert args.pretrained_embeddings, "--use_pretrained needs --pretrained_embeddings, build it once with causalchains.utils.pretrained_cache"
 
     if args.load_model:
         logging.info("Loading the Model")
@@ -110,6 +136,11 @@ def train(args):
 
 
     model = model.to(device=args.device)
+    distributed.broadcast_parameters(args, model)
+
+    if args.optimizer.startswith('sparse_'):
+        logging.info("Using sparse gradients for the embeddings")
+        use_sparse_embeddings(model)
 
     #create the optimizer
     if args.load_opt:
@@ -122,6 +153,9 @@ def train(args):
         elif args.optimizer == 'sgd':
             logging.info("Creating SGD optimizer anew")
             optimizer = torch.optim.SGD(filter(lambda x: x.requires_grad, model.parameters()), lr=args.lr)
+        elif args.optimizer.startswith('sparse_'):
+            logging.info("Creating split sparse/dense optimizer anew")
+            optimizer = make_split_optimizer(model, args.optimizer, args.lr)
         else:
             logging.info("Creating Adam optimizer anew")
             optimizer = torch.optim.Adam(filter(lambda x: x.requires_grad, model.parameters()), lr=args.lr)
@@ -129,94 +163,248 @@ def train(args):
     logging.info("Loading Datasets")
     min_size = model.text_encoder.largest_ngram_size #Add extra pads if text size smaller than largest CNN kernel size
 
-    if args.load_pickle:
+    if args.train_shards:
+        train_dataset = None
+        train_shards = expand_shards(args.train_shards)
+        logging.info("Streaming Train from {} shards".format(len(train_shards)))
+    elif args.train_cache:
+        logging.info("Loading Train from Cache {}".format(args.train_cache))
+        train_dataset = MappedInstanceDataset(args.train_cache, min_size=min_size)
+    elif args.load_pickle:
         logging.info("Loading Train from Pickled Data")
         with open(args.train_data, 'rb') as pfi:
             pickled_examples = pickle.load(pfi)
         train_dataset = du.InstanceDataset("", evocab, tvocab, min_size=min_size, pickled_examples=pickled_examples) 
     else:
         train_dataset = du.InstanceDataset(args.train_data, evocab, tvocab, min_size=min_size) 
-    valid_dataset = du.InstanceDataset(args.valid_data, evocab, tvocab, min_size=min_size)
+
+    if args.valid_cache:
+        valid_dataset = MappedInstanceDataset(args.valid_cache, min_size=min_size)
+    else:
+        valid_dataset = du.InstanceDataset(args.valid_data, evocab, tvocab, min_size=min_size)
 
     #Remove UNK events from the e1prev_intext attribute so they don't mess up avg encoders
   #  train_dataset.filter_examples(['e1prev_intext'])  #These take really long time! Will have to figure something out...
   #  valid_dataset.filter_examples(['e1prev_intext'])
-    logging.info("Finished Loading Training Dataset {} examples".format(len(train_dataset)))
+    if train_dataset is not None:
+        logging.info("Finished Loading Training Dataset {} examples".format(len(train_dataset)))
     logging.info("Finished Loading Valid Dataset {} examples".format(len(valid_dataset)))
 
-    train_batches = BatchIter(train_dataset, args.batch_size, sort_key=lambda x:len(x.allprev), train=True, repeat=False, shuffle=True, sort_within_batch=True, device=None)
-    valid_batches = BatchIter(valid_dataset, args.batch_size, sort_key=lambda x:len(x.allprev), train=False, repeat=False, shuffle=False, sort_within_batch=True, device=None)
-    train_data_len = len(train_dataset)
+    if args.train_shards:
+        if args.max_tokens > 0:
+            logging.warning("Streamed training batches have a fixed batch size, --max_tokens only applies to validation")
+        train_batches = StreamingInstanceBatches(train_shards, evocab, tvocab, args.batch_size, min_size=min_size, 
+                                                 shuffle_buffer=args.shuffle_buffer, bucket_window=args.bucket_window, seed=args.seed)
+    elif args.max_tokens > 0:
+        train_batches = token_budget_source(args, train_dataset, min_size, train=True)
+    elif args.train_cache:
+        train_batches = MappedBatchIter(train_dataset, args.batch_size, train=True, seed=args.seed)
+    elif args.num_workers > 0:
+        train_batches = ExampleBatchPlan(train_dataset, args.batch_size, sort_key=lambda x:len(x.allprev), train=True, seed=args.seed)
+    else:
+        train_batches = BatchIter(train_dataset, args.batch_size, sort_key=lambda x:len(x.allprev), train=True, repeat=False, shuffle=True, sort_within_batch=True, device=None)
+
+    if args.max_tokens > 0:
+        valid_batches = token_budget_source(args, valid_dataset, min_size, train=False)
+    elif args.valid_cache:
+        valid_batches = MappedBatchIter(valid_dataset, args.batch_size, train=False)
+    elif args.num_workers > 0:
+        valid_batches = ExampleBatchPlan(valid_dataset, args.batch_size, sort_key=lambda x:len(x.allprev), train=False)
+    else:
+        valid_batches = BatchIter(valid_dataset, args.batch_size, sort_key=lambda x:len(x.allprev), train=False, repeat=False, shuffle=False, sort_within_batch=True, device=None)
+
+    #With data parallel training, each rank only gets its share of the batches
+    train_batches = distributed.shard_batches(args, train_batches)
+    valid_batches = distributed.shard_batches(args, valid_batches, drop_last=False)
+    valid_source = valid_batches #without prefetching (cpu batches), for the async validation worker
+
+    mid_valid_batches = valid_batches
+    if args.valid_subsample > 0:
+        #Mid epoch checks only look at a fixed stratified (by e2) subsample, built once
+        if args.valid_cache:
+            subsample_source = MappedBatchIter(valid_dataset, args.batch_size, train=False)
+            labels = list(valid_dataset.ids['e2'])
+        else:
+            subsample_source = ExampleBatchPlan(valid_dataset, args.batch_size, sort_key=lambda x:len(x.allprev), train=False)
+            labels = [x.e2 for x in valid_dataset.examples]
+        mid_valid_batches = subsample_batches(subsample_source, labels, args.valid_subsample, args.batch_size, seed=args.seed)
+        mid_valid_batches = mid_valid_batches[args.rank::args.world_size] #each rank its share, like the full set
+        logging.info("Mid epoch validation on a subsample of {} instances".format(args.valid_subsample))
+
+    if args.num_workers > 0:
+        #Build batches in background processes, they come out already on args.device
+        train_batches = PrefetchBatches(train_batches, args.num_workers, args.prefetch, device=args.device)
+        valid_batches = PrefetchBatches(valid_batches, args.num_workers, args.prefetch, device=args.device)
     valid_data_len = len(valid_dataset)
 
 
     loss_func = nn.CrossEntropyLoss()
+    if args.sampled_softmax > 0:
+        logging.info("Training with sampled softmax, {} {} samples per batch".format(args.sampled_softmax, args.sampler))
+        sampler = make_sampler(args, evocab)
 
     start_time = time.time() #start of epoch 1
     best_valid_loss= float('inf')
     best_epoch = args.epochs 
-
-
-    if args.finetune:
+    start_epoch = 0
+    start_iteration = 0 #batches of start_epoch already trained on
+    checkpoint_file = args.checkpoint if args.checkpoint else "{}_checkpoint".format(args.save_model)
+
+    if args.resume:
+        trainer_state = checkpoint.load_checkpoint(args.resume, model, optimizer, device=args.device)
+        start_epoch, start_iteration = trainer_state['epoch'], trainer_state['iteration']
+        best_valid_loss, best_epoch = trainer_state['best_valid_loss'], trainer_state['best_epoch']
+
+    telemetry = Telemetry(args.telemetry if distributed.is_main(args) else None, device=args.device)
+
+    def save_checkpoint(epoch, iteration):
+        if distributed.is_main(args):
+            checkpoint.save_checkpoint(checkpoint_file, model, optimizer, {'epoch': epoch, 'iteration': iteration, 'best_valid_loss': best_valid_loss, 'best_epoch': best_epoch})
+
+
+    validator = None
+    if args.async_validation:
+        assert not distributed.is_distributed(args), "--async_validation does not work with data parallel training"
+        logging.info("Validating in a background process")
+        worker_args = copy.copy(args)
+        worker_args.device = torch.device('cpu')
+        validator = AsyncValidator(functools.partial(snapshot_validation, worker_args, loss_func), 
+                                   model, {'full': valid_source, 'subsample': mid_valid_batches}, threads=args.validation_threads)
+
+    def validation_done(info, new_valid_loss, model_to_save):
+        'Log a validation result, and save model_to_save if it is a new best'
+        nonlocal best_valid_loss, best_epoch
+        if info['iteration'] is None:
+            where = "at end of Epoch {}".format(info['epoch'])
+        else:
+            where = "at Epoch/iteration {}/{}".format(info['epoch'], info['iteration'])
+        if info['name'] == 'subsample': #not comparable with full validation losses, just for keeping an eye on things
+            logging.info("Subsample validation loss {}: {:.3f}".format(where, new_valid_loss))
+            return
+        logging.info("Validation loss {}: {:.3f} - Best Validation Loss: {:.3f}".format(where, new_valid_loss, best_valid_loss))
+        if new_valid_loss < best_valid_loss:
+            logging.info("New Validation Best...Saving Model Checkpoint")  
+            best_valid_loss = new_valid_loss
+            best_epoch = info['epoch']
+            #torch.save(model, "{}.epoch_{}.loss_{:.2f}.pt".format(args.save_model, curr_epoch, best_valid_loss))
+            #torch.save(optimizer, "{}.{}.epoch_{}.loss_{:.2f}.pt".format(args.save_model, "optimizer", curr_epoch, best_valid_loss))
+            if distributed.is_main(args):
+                torch.save(model_to_save, "{}".format(args.save_model))
+                torch.save(optimizer, "{}_optimizer".format(args.save_model)) #with async validation, this is the current optimizer state
+
+    def run_validation(name, epoch, iteration=None):
+        'Validate on the full set or the subsample, either right now or in the background (results come from poll_validation)'
+        info = {'name': name, 'epoch': epoch, 'iteration': iteration}
+        with telemetry.phase('validation'):
+            if validator is not None:
+                validator.submit(name, model, info)
+            else:
+                batches = valid_batches if name == 'full' else mid_valid_batches
+                validation_done(info, validation(args, batches, model, loss_func), model)
+
+    def poll_validation(block=False):
+        if validator is not None:
+            for info, new_valid_loss, snapshot in validator.poll(block):
+                validation_done(info, new_valid_loss, validator.snapshot_model(snapshot)) #save the weights that were validated
+
+    if args.finetune and not args.resume:
         vloss = validation(args, valid_batches, model, loss_func)
         logging.info("Pre Finetune Validation Loss: {}".format(vloss))
 
+    clip_params = dense_parameters(model) #sparse embedding gradients are not clipped
+
+    def update():
+        'Step with the gradients accumulated since the last update (scaled to the average over all the instances they cover)'
+        if args.update_instances > 0:
+            total_instances = distributed.all_reduce_sum(args, [accum_instances])[0] #over all ranks
+            for param in model.parameters():
+                if param.grad is not None:
+                    param.grad.data.div_(total_instances / args.world_size) #average_gradients divides by world_size too
+        distributed.average_gradients(args, model)
+        torch.nn.utils.clip_grad_norm(clip_params, args.clip)
+        optimizer.step() 
+        model.zero_grad()
+
     #MAIN TRAINING LOOP
-    for curr_epoch in range(args.epochs):
+    model.zero_grad()
+    accum_instances = 0 #instances in the gradients accumulated so far (with update_instances)
+    checkpoint_due = False
+    for curr_epoch in range(start_epoch, args.epochs):
         prev_losses = []
-        for iteration, inst in enumerate(train_batches): 
+        skip = start_iteration if curr_epoch == start_epoch else 0
+        du.set_epoch(train_batches, curr_epoch, skip, args.seed) #order of the epoch only depends on the seed, so we can restart in the middle
+        telemetry.start_wait()
+        for iteration, inst in enumerate(train_batches, skip): 
+            telemetry.end_wait()
             instance = du.send_instance_to(inst, args.device)
 
             model.train()
-            model.zero_grad()
-            model_outputs = model(instance) 
-
-            exp_outcome_out = model_outputs[EXP_OUTCOME_COMPONENT]  #[batch X num events], output predication for e2
-            exp_outcome_loss = loss_func(exp_outcome_out, instance.e2)
-            loss = exp_outcome_loss
+            with telemetry.phase('forward'):
+                if args.sampled_softmax > 0: #Only compute logits for e2 and some sampled events (validation still uses the full softmax)
+                    sampled = sampler.sample()
+                    target_logits, sampled_logits = model.expected_outcome.sampled_logits(instance, instance.e2, sampled)
+                    exp_outcome_loss = sampled_softmax_loss(target_logits, sampled_logits, instance.e2, sampled, sampler)
+                else:
+                    model_outputs = model(instance) 
+
+                    exp_outcome_out = model_outputs[EXP_OUTCOME_COMPONENT]  #[batch X num events], output predication for e2
+                    exp_outcome_loss = loss_func(exp_outcome_out, instance.e2)
+                loss = exp_outcome_loss
             
-            loss.backward()
-            torch.nn.utils.clip_grad_norm(model.parameters(), args.clip)
-            optimizer.step() 
+            with telemetry.phase('backward'):
+                if args.update_instances > 0: #weight each batch by its size, since token budget batch sizes vary
+                    (loss*len(instance.e2)).backward()
+                    accum_instances += len(instance.e2)
+                else:
+                    loss.backward()
+            if args.update_instances <= 0 or distributed.all_reduce_sum(args, [accum_instances])[0] >= args.update_instances:
+                with telemetry.phase('optimizer'):
+                    update()
+                accum_instances = 0
 
             prev_losses.append(loss.cpu().data)
             prev_losses = prev_losses[-50:]
+            telemetry.count(len(instance.e2), *instance_tokens(instance))
 
             if (iteration % args.log_every == 0) and iteration != 0:
                 past_50_avg = sum(prev_losses) / len(prev_losses)
                 logging.info("Epoch/iteration {}/{}, Past 50 Average Loss {}, Best Val {} at Epoch {}".format(curr_epoch, iteration, past_50_avg, 'NA' if best_valid_loss == float('inf') else best_valid_loss, 'NA' if best_epoch == args.epochs else best_epoch))
+                telemetry.write(curr_epoch, iteration, loss=float(past_50_avg))
 
+            poll_validation()
             if (iteration % args.validate_after == 0) and iteration != 0:
                 logging.info("Running Validation at Epoch/iteration {}/{}".format(curr_epoch, iteration))
-                new_valid_loss = validation(args, valid_batches, model, loss_func)
-                logging.info("Validation loss at Epoch/iteration {}/{}: {:.3f} - Best Validation Loss: {:.3f}".format(curr_epoch, iteration, new_valid_loss, best_valid_loss))
-                if new_valid_loss < best_valid_loss:
-                    logging.info("New Validation Best...Saving Model Checkpoint")  
-                    best_valid_loss = new_valid_loss
-                    best_epoch = curr_epoch
-                    #torch.save(model, "{}.epoch_{}.loss_{:.2f}.pt".format(args.save_model, curr_epoch, best_valid_loss))
-                    #torch.save(optimizer, "{}.{}.epoch_{}.loss_{:.2f}.pt".format(args.save_model, "optimizer", curr_epoch, best_valid_loss))
-                    torch.save(model, "{}".format(args.save_model))
-                    torch.save(optimizer, "{}_optimizer".format(args.save_model))
+                run_validation('subsample' if args.valid_subsample > 0 else 'full', curr_epoch, iteration)
+
+            if args.checkpoint_every > 0 and (iteration+1) % args.checkpoint_every == 0:
+                checkpoint_due = True
+            if checkpoint_due and accum_instances == 0: #only right after an update, partly accumulated gradients are not saved
+                save_checkpoint(curr_epoch, iteration+1)
+                checkpoint_due = False
+            telemetry.start_wait()
 
         #END OF EPOCH
+        telemetry.end_wait()
+        if accum_instances > 0: #dont carry a partial update into the next epoch
+            update()
+            accum_instances = 0
         logging.info("End of Epoch {}, Running Validation".format(curr_epoch))
-        new_valid_loss = validation(args, valid_batches, model, loss_func)
-        logging.info("Validation loss at end of Epoch {}: {:.3f} - Best Validation Loss: {:.3f}".format(curr_epoch, new_valid_loss, best_valid_loss))
-        if new_valid_loss < best_valid_loss:
-            logging.info("New Validation Best...Saving Model Checkpoint")  
-            best_valid_loss = new_valid_loss
-            best_epoch = curr_epoch
-            #torch.save(model, "{}.epoch_{}.loss_{:.2f}.pt".format(args.save_model, curr_epoch, best_valid_loss))
-            #torch.save(optimizer, "{}.{}.epoch_{}.loss_{:.2f}.pt".format(args.save_model, "optimizer", curr_epoch, best_valid_loss))
-            torch.save(model, "{}".format(args.save_model))
-            torch.save(optimizer, "{}_optimizer".format(args.save_model))
+        run_validation('full', curr_epoch)
+        poll_validation() #with async validation, the stopping check below can lag behind by an epoch
+
+        if args.checkpoint_every > 0:
+            save_checkpoint(curr_epoch+1, 0) #the partial update was flushed above
+            checkpoint_due = False
 
         if curr_epoch - best_epoch >= args.stop_after:
             logging.info("No improvement in {} epochs, terminating at epoch {}...".format(args.stop_after, curr_epoch))
             logging.info("Best Validation Loss: {:.2f} at Epoch {}".format(best_valid_loss, best_epoch))
             break
 
+    if validator is not None:
+        poll_validation(block=True)
+        validator.close()
+
              
 
 
@@ -234,7 +422,7 @@ if __name__ == "__main__":
     parser.add_argument('--lr', type=float, default=0.001, help='initial learning rate')
     parser.add_argument('--log_every', type=int, default=500)
     parser.add_argument('--validate_after', type=int, default=5000)
-    parser.add_argument('--optimizer', type=str, default='adam', help='adam, adagrad, sgd')
+    parser.add_argument('--optimizer', type=str, default='adam', choices=OPTIMIZERS, help='adam, adagrad, sgd, or sparse_adam/sparse_adagrad (sparse embedding gradients with SparseAdam/Adagrad, Adam for the rest)')
     parser.add_argument('--clip', type=float, default=10.0, help='gradient clipping')
     parser.add_argument('--epochs', type=int, default=40, help='upper epoch limit')
     parser.add_argument('--stop_after', type=int, default=3, help='Stop after this many epochs have passed without decrease in validation loss')
@@ -248,9 +436,33 @@ if __name__ == "__main__":
     parser.add_argument('--combine_events', action='store_true', help='Combine e1 with previous context (average it in if using embeddings)')
     parser.add_argument('--rnn_event_encoder', action='store_true', help='Encode events with rnn')
     parser.add_argument('--use_pretrained', action='store_true', help='Use pretrained glove embeddings')
+    parser.add_argument('--pretrained_embeddings', type=str, default=None, help='Pretrained word vectors aligned to tvocab (.npy from causalchains.utils.pretrained_cache) for --use_pretrained')
     parser.add_argument('--finetune', action='store_true', help='Fine tune on out of text events')
     parser.add_argument('--freeze', action='store_true', help='Freeze previous layers')
     parser.add_argument('--load_pickle', action='store_true', help='Load preprocessed (pickled) examples, is quicker')
+    parser.add_argument('--train_cache', type=str, default=None, help='Memory mapped cache of the training data (causalchains.utils.instance_cache), used instead of train_data')
+    parser.add_argument('--train_shards', type=str, nargs='+', default=None, help='Stream training data from these shards (jsonl files or instance_cache directories, glob patterns ok) instead of loading it all')
+    parser.add_argument('--shuffle_buffer', type=int, default=100000, help='Number of instances in the shuffle buffer when streaming with --train_shards')
+    parser.add_argument('--bucket_window', type=int, default=100, help='Sort by length within windows of this many batches when streaming with --train_shards')
+    parser.add_argument('--sampled_softmax', type=int, default=0, help='Train with a sampled softmax over this many sampled events per batch (0 uses the full softmax)')
+    parser.add_argument('--sampler', type=str, default='unigram', choices=SAMPLERS, help='Distribution to sample events from for --sampled_softmax')
+    parser.add_argument('--sampler_power', type=float, default=0.75, help='Power to raise event frequencies to for the unigram sampler')
+    parser.add_argument('--checkpoint_every', type=int, default=0, help='Save a resumable checkpoint every this many iterations (at the next update with --update_instances) and at the end of every epoch (0 for never)')
+    parser.add_argument('--checkpoint', type=str, default=None, help='File for resumable checkpoints (default save_model + _checkpoint)')
+    parser.add_argument('--resume', type=str, default=None, help='Resumable checkpoint to continue training from (use the same arguments as the original run)')
+    parser.add_argument('--telemetry', type=str, default=None, help='Append per log interval timings/throughput records (jsonl) to this file')
+    parser.add_argument('--world_size', type=int, default=1, help='Total number of data parallel (gloo) training processes, over all nodes')
+    parser.add_argument('--nprocs', type=int, default=None, help='Number of training processes to launch on this node (default world_size)')
+    parser.add_argument('--node_rank', type=int, default=0, help='Index of this node when training over several nodes')
+    parser.add_argument('--dist_url', type=str, default='tcp://127.0.0.1:23456', help='Address of the rank 0 process for data parallel training')
+    parser.add_argument('--num_workers', type=int, default=0, help='Number of background processes building batches (0 builds them in the training loop)')
+    parser.add_argument('--prefetch', type=int, default=8, help='Maximum number of batches the workers build ahead of training')
+    parser.add_argument('--max_tokens', type=int, default=0, help='Fill batches up to this many padded e1_text + allprev tokens, bucketing on both lengths, instead of batch_size instances (0 for fixed batch_size)')
+    parser.add_argument('--update_instances', type=int, default=0, help='Accumulate gradients over batches until at least this many instances (over all ranks) before each update, keeps the effective batch size stable with --max_tokens (0 updates every batch)')
+    parser.add_argument('--async_validation', action='store_true', help='Validate snapshots of the weights in a background (cpu) process while training continues')
+    parser.add_argument('--validation_threads', type=int, default=1, help='Torch threads for the background validation process')
+    parser.add_argument('--valid_subsample', type=int, default=0, help='Mid epoch validations only use a fixed stratified subsample of this many instances (logged only, bests are picked at the end of epochs)')
+    parser.add_argument('--valid_cache', type=str, default=None, help='Memory mapped cache of the validation data, used instead of valid_data')
 
 
     logging.basicConfig(level=logging.INFO)
@@ -278,7 +490,7 @@ if __name__ == "__main__":
         args.device = torch.device('cpu')
     
 
-    train(args)
+    distributed.launch(train, args)
 
 
 
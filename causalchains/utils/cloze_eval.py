@@ -5,6 +5,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from causalchains.utils.data_utils import EOS_TOK, SOS_TOK
 import causalchains.utils.data_utils as du
+import causalchains.utils.score_matrix as score_matrix
 import json
 import csv
 import pickle
@@ -18,21 +19,19 @@ def top_causal_choices(chain, scores, evocab, so_events):
     for a ending to the chain
     params:
         (str) chain : a list of string representation of the event
-        scores : the output of causalchains.train.testing.normalized_intervention_mat, a tuple
-                 with (interven_dists, so_events_itos, so_events_stoi), where intervention dist is a matrix
+        scores (score_matrix.ScoreMatrix) : the output of causalchains.train.testing.normalized_scores_matrix, a matrix
                  whose jth column is a normalized selection of potential causes of e2
         evocab: The original event vocabulary
     """
-    score_mat = torch.Tensor(scores[0])
     evocab_scores = []
     #for idx, last_e in enumerate(evocab.itos):
     for idx, last_e in enumerate(so_events):
         #if last_e in so_events:
         scor = 0
-        prev_event_scores = score_mat[:, evocab.stoi[last_e]].tolist() #compatibility scores for previous events for this vocab item
+        prev_event_scores = scores.column(evocab.stoi[last_e]).tolist() #compatibility scores for previous events for this vocab item
         for ev in chain:
-            if ev in scores[2]:
-                scor += prev_event_scores[scores[2][ev]]
+            if ev in scores.row_stoi:
+                scor += prev_event_scores[scores.row_stoi[ev]]
             else:
                 scor += 0
         scor = scor / len(chain)
@@ -86,14 +85,7 @@ def top_lm_choices(args, model, example, evocab, so_events):
     #Process the prefix
     text_inst= torch.LongTensor([evocab.stoi[SOS_TOK]] + [evocab.stoi[x] for x in example]).to(device=args.device) #seqlen tensor]
     
-    hidden=None
-    logits = None
-    for step in range(text_inst.shape[0]):
-        step_inp = text_inst[step] #get all instances for this step
-        step_inp = step_inp.unsqueeze(0).unsqueeze(0) #[1 X 1]
-
-        logit_i, hidden = model(step_inp, hidden)
-        logits = logit_i #[1 X vocab]
+    logits, hidden = model.prefix_logits(text_inst) #[1 X vocab], only the last step goes through the output layer
 
     logits = logits.squeeze(dim=0).cpu().tolist()
     for idx, score in enumerate(logits):
@@ -291,8 +283,7 @@ if __name__ == "__main__":
     with open(args.pmi_dict, 'r') as fi:
         pmi_dict = json.load(fi)
 
-    with open(args.causal_dict, 'rb') as fi:
-        causal_dict = pickle.load(fi)
+    causal_dict = score_matrix.load_score_matrix(args.causal_dict)
 
     evocab_lm = du.convert_to_lm_vocab(copy.deepcopy(evocab))
     lm_model = torch.load(args.lm_model, map_location=args.device)
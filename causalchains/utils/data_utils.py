@@ -10,6 +10,7 @@ import torch
 import torch.nn as nn
 import numpy as np
 import math
+import random
 import json
 import pickle
 from torch.utils.data import Dataset, DataLoader
@@ -123,6 +124,20 @@ class ExtendableField(ttdata.Field):
         raise NotImplementedError
 
 
+def set_epoch(batches, epoch, skip=0, seed=11):
+    """
+    Make the next pass over batches be epoch number epoch, starting after its first skip batches. The order of an epoch
+    then only depends on seed and epoch, so training can be restarted in the middle of one.
+    Params:
+        batches : a torchtext Iterator (BatchIter), or one of the batch iterators with a set_epoch method
+                  (instance_cache.MappedBatchIter, stream_data.StreamingInstanceBatches, prefetch.PrefetchBatches, ...)
+    """
+    if hasattr(batches, 'set_epoch'):
+        batches.set_epoch(epoch, skip, seed)
+    else: #torchtext Iterator, seed its shuffler for this epoch and let it skip ahead
+        batches.load_state_dict({'iterations': 0, 'iterations_this_epoch': skip, 'random_state_this_epoch': random.Random(seed + epoch).getstate()})
+
+
 def send_instance_to(instance, device):
     """
     Convert Batch object so that it goes on device(gpu/cpu)
@@ -135,6 +150,107 @@ def send_instance_to(instance, device):
     instance.e1prev_outtext= (instance.e1prev_outtext[0].to(device=device), instance.e1prev_outtext[1].to(device=device))
     return instance
 
+class TensorBatch(object):
+    'Holds just the tensors of a torchtext Batch from InstanceDataset, so it can be pickled and shared between processes'
+    FIELDS = ['e1_text', 'e1', 'e2', 'e1prev_intext', 'allprev', 'e1prev_outtext']
+
+    def __init__(self, batch):
+        for name in self.FIELDS:
+            setattr(self, name, getattr(batch, name))
+
+    @classmethod
+    def from_fields(cls, fields):
+        'Build from a dict mapping each of FIELDS to its tensor (or (tensor, lengths) tuple)'
+        batch = cls.__new__(cls)
+        for name in cls.FIELDS:
+            setattr(batch, name, fields[name])
+        return batch
+
+    def _apply(self, func):
+        batch = type(self).__new__(type(self))
+        for name in self.FIELDS:
+            value = getattr(self, name)
+            setattr(batch, name, tuple(func(x) for x in value) if isinstance(value, tuple) else func(value))
+        return batch
+
+    def to(self, device, non_blocking=False):
+        'Return a copy on device (the original stays where it is)'
+        return self._apply(lambda x: x.to(device=device, non_blocking=non_blocking))
+
+    def pin_memory(self):
+        'Return a copy in page locked memory, for faster (non_blocking) copies to the gpu'
+        return self._apply(lambda x: x.pin_memory())
+
+    def intervene(self, e1):
+        """
+        Return a copy with every instance's e1 set to e1, the same as setting example.e1 = e1 and
+        example.allprev = example.e1prev_intext + [e1] before batching (but without renumericalizing/padding)
+        Params:
+            e1 (int) : index of the event to intervene with
+        """
+        batch = self._apply(lambda x: x)
+        batch.e1 = torch.full_like(self.e1, e1)
+        allprev, allprev_lens = self.allprev
+        allprev = allprev.clone()
+        allprev[torch.arange(allprev.shape[0], device=allprev.device), allprev_lens - 1] = e1 #e1 is the last of allprev
+        batch.allprev = (allprev, allprev_lens)
+        return batch
+
+    def share_memory_(self):
+        self._apply(lambda x: x.share_memory_())
+        return self
+
+    def __len__(self):
+        return self.e1.shape[0]
+
+
+class LmTensorBatch(TensorBatch):
+    'TensorBatch for a torchtext Batch of LmInstanceDataset'
+    FIELDS = ['text', 'target']
+
+    def __len__(self):
+        return self.text[0].shape[0]
+
+
+def token_id(vocab, tok):
+    'Id of tok in vocab, UNK for unknown tokens (without adding them to vocab.stoi, a defaultdict)'
+    return vocab.stoi.get(tok, vocab.stoi[UNK_TOK])
+
+
+def numericalize_instance(json_line, event_vocab, text_vocab):
+    """
+    Convert one (already json loaded) line of an InstanceDataset file to token ids, the same way InstanceDataset's fields do
+    Unknown tokens get the UNK id, and neither vocab is modified
+    Returns:
+        (dict) maps each of TensorBatch.FIELDS to an id (e1, e2) or list of ids
+    """
+    e1 = token_id(event_vocab, json_line['e1'])
+    e1prev_intext = [token_id(event_vocab, x) for x in json_line['e1prev_intext']]
+    return {'e1_text': [token_id(text_vocab, x) for x in json_line['e1_text'].lower().split()],
+            'e1': e1,
+            'e2': token_id(event_vocab, json_line['e2']),
+            'e1prev_intext': e1prev_intext,
+            'allprev': e1prev_intext + [e1],
+            'e1prev_outtext': [token_id(event_vocab, x) for x in json_line.get('e1prev_outtext', [])]}
+
+
+def collate_instances(instances, e_pad, t_pad, min_size=5):
+    """
+    Pad a list of numericalized instances (output of numericalize_instance) into a TensorBatch,
+    the same as a torchtext Batch of InstanceDataset (text is padded to at least min_size)
+    """
+    def pad(seqs, pad_idx, min_len=0):
+        max_len = max([len(x) for x in seqs] + [min_len])
+        return (torch.LongTensor([x + [pad_idx]*(max_len - len(x)) for x in seqs]).view(len(seqs), max_len), torch.LongTensor([len(x) for x in seqs]))
+
+    fields = {'e1_text': pad([x['e1_text'] for x in instances], t_pad, min_size),
+              'e1': torch.LongTensor([x['e1'] for x in instances]),
+              'e2': torch.LongTensor([x['e2'] for x in instances])}
+    for name in ['e1prev_intext', 'allprev', 'e1prev_outtext']:
+        fields[name] = pad([x[name] for x in instances], e_pad)
+    return TensorBatch.from_fields(fields)
+
+
 def lm_send_instance_to(instance, device):
     """
     Convert Batch object so that it goes on device(gpu/cpu)
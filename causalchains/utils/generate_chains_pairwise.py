@@ -5,6 +5,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from causalchains.utils.data_utils import EOS_TOK, SOS_TOK
 import causalchains.utils.data_utils as du
+import causalchains.utils.score_matrix as score_matrix
 import json
 import csv
 import pickle
@@ -32,13 +33,12 @@ def top_e1_choices(e2, scores, evocab):
     for a e1 that would explain e2. 
     params:
         (str) e2 : a string representation of the second event
-        scores : the output of causalchains.train.testing.normalized_intervention_mat, a tuple
-                 with (interven_dists, so_events_itos, so_events_stoi), where intervention dist is a matrix
+        scores (score_matrix.ScoreMatrix) : the output of causalchains.train.testing.normalized_scores_matrix, a matrix
                  whose jth column is a normalized selection of potential causes of e2
+                 or a score_matrix.TopKIndex of it (only the top k choices are returned then)
         evocab: The original event vocabulary
     """
-    tops = sorted([(scores[1][i], x) for i, x in enumerate(torch.Tensor(scores[0])[:, evocab.stoi[e2]].tolist())], key=lambda l:l[1], reverse=True)
-    return [(x[0][1], x[1]) for x in tops]
+    return scores.top_causes(evocab.stoi[e2])
 
 
 def top_k_logits(logits, k): #zero out everything except the top k
@@ -116,14 +116,7 @@ def complete_chains_lm(model, example, evocab, topk=5, max_len=20):
     #Process the prefix
     text_inst= torch.LongTensor([evocab.stoi[SOS_TOK]] + [evocab.stoi[x] for x in example]) #seqlen tensor]
     
-    hidden=None
-    logits = None
-    for step in range(text_inst.shape[0]):
-        step_inp = text_inst[step] #get all instances for this step
-        step_inp = step_inp.unsqueeze(0).unsqueeze(0) #[1 X 1]
-
-        logit_i, hidden = model(step_inp, hidden)
-        logits = logit_i #[1 X vocab]
+    logits, hidden = model.prefix_logits(text_inst) #[1 X vocab], only the last step goes through the output layer
 
     #decode
     for i in range(max_len):
@@ -157,15 +150,7 @@ def pairwise_lm_prob(model, example, evocab, topk=300):
     #Process the prefix
     text_inst= torch.LongTensor([evocab.stoi[SOS_TOK]] + [evocab.stoi[example]]) #seqlen tensor]
     
-    hidden=None
-    logits = None
-    for step in range(text_inst.shape[0]):
-        print("INPUTTINN {}".format(evocab.itos[text_inst[step]]))
-        step_inp = text_inst[step] #get all instances for this step
-        step_inp = step_inp.unsqueeze(0).unsqueeze(0) #[1 X 1]
-
-        logit_i, hidden = model(step_inp, hidden)
-        logits = logit_i #[1 X vocab]
+    logits, hidden = model.prefix_logits(text_inst) #[1 X vocab], only the last step goes through the output layer
 
     #decode
     already_used = [evocab.stoi[example]] + [evocab.stoi['<unk>']]
@@ -212,6 +197,8 @@ if __name__ == "__main__":
     parser.add_argument('--turk_format', action='store_true')
     parser.add_argument('--outfile', type=str)
     parser.add_argument('--lm_dict', type=str, default=None)
+    parser.add_argument('--causal_topk', type=str, default=None, help='Sparse top k index of causal_dict (testing --topk), used instead of causal_dict')
+    parser.add_argument('--lm_topk', type=str, default=None, help='Sparse top k index of lm_dict, used instead of lm_dict')
     args = parser.parse_args()
 
 
@@ -226,8 +213,10 @@ if __name__ == "__main__":
     with open(args.pmi_dict, 'r') as fi:
         pmi_dict = json.load(fi)
 
-    with open(args.causal_dict, 'rb') as fi:
-        causal_dict = pickle.load(fi)
+    if args.causal_topk is not None:
+        causal_dict = score_matrix.load_topk_index(args.causal_topk)
+    else:
+        causal_dict = score_matrix.load_score_matrix(args.causal_dict)
 
     global BAD_WORDS
 
@@ -236,10 +225,9 @@ if __name__ == "__main__":
         BAD_WORDS = [x.rstrip() for x in bword_lines]
 
 
-    if args.lm_dict is not None:
+    if args.lm_dict is not None or args.lm_topk is not None:
         evocab_lm = du.convert_to_lm_vocab(copy.deepcopy(evocab))
-        with open(args.lm_dict, 'rb') as fi:
-            lm_dict = pickle.load(fi)
+        lm_dict = score_matrix.load_topk_index(args.lm_topk) if args.lm_topk is not None else score_matrix.load_score_matrix(args.lm_dict)
     else:
         evocab_lm = None
         lm_dict = None
@@ -258,7 +246,7 @@ if __name__ == "__main__":
 
     if not args.turk_format:
         with open(args.outfile, 'w') as fi:
-            if args.lm_dict is not None:
+            if args.lm_dict is not None or args.lm_topk is not None:
                 for idx, (pmi, causal, lm) in enumerate(zip(pmi_res, causal_res, lm_res)):
                     assert pmi[0] == causal[0] == lm[0]
                     fi.write("Event 2: {}\n".format(pmi[0]))
@@ -0,0 +1,310 @@
+################################
+# Numericalized, memory mapped cache of an InstanceDataset file
+# Build it once with
+#   python -m causalchains.utils.instance_cache --data train.jsonl --out train_cache/
+# then train with --train_cache train_cache/ instead of --load_pickle.
+#
+# Each sequence field is stored as a flat int32 token array plus an int64
+# offsets array (instance i is tokens[offsets[i]:offsets[i+1]]), e1 and e2
+# as int32 arrays. Everything is memmapped, so startup is instant and the
+# pages are shared between jobs using the same cache.
+################################
+import torch
+import numpy as np
+import argparse
+import json
+import os
+import logging
+from array import array
+import causalchains.utils.data_utils as du
+from causalchains.utils.data_utils import PAD_TOK
+
+META = "meta.json"
+SCALAR_FIELDS = ['e1', 'e2']
+SEQUENCE_FIELDS = ['e1_text', 'e1prev_intext', 'allprev', 'e1prev_outtext']
+
+
+def build_instance_cache(path, outdir, event_vocab, text_vocab, filter_unk_events=True, log_every=1000000):
+    """
+    Numericalize the InstanceDataset file at path and write the cache to outdir
+    Params:
+        filter_unk_events (bool) : Remove instances where either e1 or e2 are unk (same as InstanceDataset)
+    """
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    files = {}
+    for name in SCALAR_FIELDS:
+        files[name] = open(os.path.join(outdir, "{}.ids".format(name)), 'wb')
+    offsets = {}
+    for name in SEQUENCE_FIELDS:
+        files[name] = open(os.path.join(outdir, "{}.tokens".format(name)), 'wb')
+        offsets[name] = array('q', [0])
+
+    num_instances = 0
+    with open(path, 'r') as fi:
+        for line in fi:
+            json_line = json.loads(line)
+            if filter_unk_events and (json_line['e1'] not in event_vocab.stoi or json_line['e2'] not in event_vocab.stoi):
+                continue
+            instance = du.numericalize_instance(json_line, event_vocab, text_vocab)
+            for name in SCALAR_FIELDS:
+                files[name].write(array('i', [instance[name]]).tobytes())
+            for name in SEQUENCE_FIELDS:
+                files[name].write(array('i', instance[name]).tobytes())
+                offsets[name].append(offsets[name][-1] + len(instance[name]))
+            num_instances += 1
+            if num_instances % log_every == 0:
+                logging.info("Cached {} instances".format(num_instances))
+
+    for name in SEQUENCE_FIELDS:
+        with open(os.path.join(outdir, "{}.offsets".format(name)), 'wb') as offi:
+            offi.write(offsets[name].tobytes())
+    for fi in files.values():
+        fi.close()
+
+    meta = {'num_instances': num_instances,
+            'num_tokens': dict([(name, offsets[name][-1]) for name in SEQUENCE_FIELDS]),
+            'e_pad': event_vocab.stoi[PAD_TOK],
+            't_pad': text_vocab.stoi[PAD_TOK],
+            'evocab_size': len(event_vocab.itos),
+            'tvocab_size': len(text_vocab.itos)}
+    with open(os.path.join(outdir, META), 'w') as fi:
+        json.dump(meta, fi)
+    logging.info("Finished cache with {} instances".format(num_instances))
+
+
+def length_bucketed_batches(lengths, batch_size, shuffle=True, seed=11, pool_batches=100):
+    """
+    Split instances into batches the way torchtext's Iterator does for train.py
+    Params:
+        lengths (numpy array) : sort key (length) of every instance
+        shuffle (bool) : If True, shuffle, sort pools of pool_batches batches worth of instances by length, and shuffle the batches.
+                         If False, sort everything by length and batch in order (like Iterator with train=False)
+        seed (int) : the order only depends on this
+    Returns:
+        list of numpy arrays of instance indices
+    """
+    if not shuffle:
+        order = np.argsort(lengths, kind='mergesort')
+        return [order[i:i+batch_size] for i in range(0, len(order), batch_size)]
+
+    rng = np.random.RandomState(seed)
+    order = rng.permutation(len(lengths))
+    pool_size = batch_size*pool_batches
+    batches = []
+    for start in range(0, len(order), pool_size):
+        pool = order[start:start+pool_size]
+        pool = pool[np.argsort(lengths[pool], kind='mergesort')]
+        batches.extend([pool[i:i+batch_size] for i in range(0, len(pool), batch_size)])
+    return [batches[i] for i in rng.permutation(len(batches))]
+
+
+def _fill_token_budget(order, text_lengths, prev_lengths, max_tokens):
+    'Cut order into consecutive batches whose padded size, batch size * (longest text + longest allprev), fits in max_tokens'
+    batches = []
+    current = []
+    max_text = max_prev = 0
+    for idx in order:
+        new_text = max(max_text, text_lengths[idx])
+        new_prev = max(max_prev, prev_lengths[idx])
+        if current and (len(current)+1)*(new_text+new_prev) > max_tokens:
+            batches.append(np.array(current, dtype=np.int64))
+            current = []
+            new_text, new_prev = text_lengths[idx], prev_lengths[idx]
+        current.append(idx)
+        max_text, max_prev = new_text, new_prev
+    if current:
+        batches.append(np.array(current, dtype=np.int64))
+    return batches
+
+
+def token_budget_batches(text_lengths, prev_lengths, max_tokens, min_size=5, shuffle=True, seed=11, pool_size=100000):
+    """
+    Split instances into batches of varying size holding up to max_tokens padded e1_text + allprev tokens
+    (an instance bigger than the budget gets a batch of its own). Instances are sorted by e1_text length and then
+    allprev length before filling batches, so both fields are padded as little as possible
+    Params:
+        text_lengths, prev_lengths (numpy array) : e1_text and allprev length of every instance
+        min_size (int) : e1_text is always padded to at least this (the largest CNN kernel size)
+        shuffle (bool) : If True, shuffle, sort pools of pool_size instances, and shuffle the batches.
+                         If False, sort everything and batch in order
+        seed (int) : the order only depends on this
+    Returns:
+        list of numpy arrays of instance indices
+    """
+    text_lengths = np.maximum(np.asarray(text_lengths), min_size)
+    prev_lengths = np.asarray(prev_lengths)
+    if not shuffle:
+        order = np.lexsort((prev_lengths, text_lengths))
+        return _fill_token_budget(order, text_lengths, prev_lengths, max_tokens)
+
+    rng = np.random.RandomState(seed)
+    order = rng.permutation(len(text_lengths))
+    batches = []
+    for start in range(0, len(order), pool_size):
+        pool = order[start:start+pool_size]
+        pool = pool[np.lexsort((prev_lengths[pool], text_lengths[pool]))]
+        batches.extend(_fill_token_budget(pool, text_lengths, prev_lengths, max_tokens))
+    return [batches[i] for i in rng.permutation(len(batches))]
+
+
+class MappedInstanceDataset(object):
+    'A cache made by build_instance_cache, batches are sliced straight out of the memmapped arrays'
+
+    def __init__(self, cachedir, min_size=5):
+        """
+        Params:
+            cachedir (str) : output directory of build_instance_cache
+            min_size : the minimum size of text fields, pad to this size if it is not larger
+        """
+        with open(os.path.join(cachedir, META), 'r') as fi:
+            self.meta = json.load(fi)
+        self.min_size = min_size
+        self.e_pad = self.meta['e_pad']
+        self.t_pad = self.meta['t_pad']
+        num = self.meta['num_instances']
+
+        def mapped(filename, dtype, size):
+            if size == 0: #cant memmap an empty file
+                return np.zeros(0, dtype=dtype)
+            return np.memmap(os.path.join(cachedir, filename), dtype=dtype, mode='r', shape=(size,))
+
+        self.ids = dict([(name, mapped("{}.ids".format(name), np.int32, num)) for name in SCALAR_FIELDS])
+        self.tokens = dict([(name, mapped("{}.tokens".format(name), np.int32, self.meta['num_tokens'][name])) for name in SEQUENCE_FIELDS])
+        self.offsets = dict([(name, mapped("{}.offsets".format(name), np.int64, num+1)) for name in SEQUENCE_FIELDS])
+
+    def __len__(self):
+        return self.meta['num_instances']
+
+    def lengths(self, name):
+        'Length of field name for every instance, numpy array [num instances]'
+        return np.diff(self.offsets[name])
+
+    def batch(self, indices):
+        """
+        Params:
+            indices (list) : the instances to put in the batch (in order)
+        Returns:
+            du.TensorBatch, padded the same as a torchtext Batch of InstanceDataset
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        fields = {}
+        for name in SCALAR_FIELDS:
+            fields[name] = torch.from_numpy(self.ids[name][indices].astype(np.int64))
+        for name in SEQUENCE_FIELDS:
+            pad = self.t_pad if name == 'e1_text' else self.e_pad
+            starts = self.offsets[name][indices]
+            lengths = self.offsets[name][indices+1] - starts
+            max_len = int(max(lengths.max() if len(lengths) else 0, self.min_size if name == 'e1_text' else 0))
+            padded = np.full((len(indices), max_len), pad, dtype=np.int64)
+            for row, (start, length) in enumerate(zip(starts, lengths)):
+                padded[row, :length] = self.tokens[name][start:start+length]
+            fields[name] = (torch.from_numpy(padded), torch.from_numpy(lengths.astype(np.int64)))
+        return du.TensorBatch.from_fields(fields)
+
+
+class MappedBatchIter(object):
+    """
+    Batch iterator over a MappedInstanceDataset, used in place of torchtext's Iterator with the same settings train.py uses
+    (sort_key is the allprev length, batches sorted within by decreasing allprev length for the rnn encoder's packing)
+    With train=True, each epoch shuffles, sorts pools of 100 batches worth of instances by length, and shuffles the batches.
+    Epoch orders are deterministic given seed. With train=False, batches go in sorted order.
+    """
+
+    def __init__(self, dataset, batch_size, train=True, seed=11, sort_field='allprev'):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.train = train
+        self.seed = seed
+        self.epoch = 0
+        self.skip = 0
+        self.sort_lengths = dataset.lengths(sort_field)
+
+    def epoch_batches(self, epoch):
+        'Return the list of batches (each a list of instance indices) for epoch'
+        return length_bucketed_batches(self.sort_lengths, self.batch_size, shuffle=self.train, seed=self.seed + epoch)
+
+    def batch(self, indices):
+        indices = sorted(indices, key=lambda i: self.sort_lengths[i], reverse=True) #sort within batch
+        return self.dataset.batch(indices)
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def set_epoch(self, epoch, skip=0, seed=None):
+        'See data_utils.set_epoch (the order already only depends on self.seed)'
+        self.epoch = epoch
+        self.skip = skip
+
+    def __iter__(self):
+        batches = self.epoch_batches(self.epoch)[self.skip:]
+        self.epoch += 1
+        self.skip = 0
+        for indices in batches:
+            yield self.batch(indices)
+
+
+class TokenBudgetPlan(object):
+    """
+    Planned batch source (see causalchains.utils.prefetch) with token_budget_batches batches, wrapping
+    another planned source (MappedBatchIter, ExampleBatchPlan) that builds them
+    """
+
+    def __init__(self, source, text_lengths, prev_lengths, max_tokens, min_size=5, train=True, seed=11):
+        """
+        Params:
+            source : builds batches with source.batch(indices)
+            text_lengths, prev_lengths (numpy array) : e1_text and allprev length of every instance of source
+            max_tokens (int) : budget of padded e1_text + allprev tokens per batch
+        """
+        self.source = source
+        self.text_lengths = text_lengths
+        self.prev_lengths = prev_lengths
+        self.max_tokens = max_tokens
+        self.min_size = min_size
+        self.train = train
+        self.seed = seed
+        self.epoch = 0
+        self.skip = 0
+        self.num_batches = None
+
+    def epoch_batches(self, epoch):
+        batches = token_budget_batches(self.text_lengths, self.prev_lengths, self.max_tokens, min_size=self.min_size, shuffle=self.train, seed=self.seed + epoch)
+        self.num_batches = len(batches)
+        return batches
+
+    def batch(self, indices):
+        return self.source.batch(indices)
+
+    def __len__(self):
+        'Number of batches of the last planned epoch (it varies a little from epoch to epoch)'
+        if self.num_batches is None:
+            self.epoch_batches(0)
+        return self.num_batches
+
+    def set_epoch(self, epoch, skip=0, seed=None):
+        'See data_utils.set_epoch (the order already only depends on self.seed)'
+        self.epoch = epoch
+        self.skip = skip
+
+    def __iter__(self):
+        batches = self.epoch_batches(self.epoch)[self.skip:]
+        self.epoch += 1
+        self.skip = 0
+        for indices in batches:
+            yield self.batch(indices)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build a numericalized, memory mapped cache of an InstanceDataset file')
+    parser.add_argument('--data', type=str)
+    parser.add_argument('--out', type=str, help='directory to write the cache to')
+    parser.add_argument('--evocab', type=str, help='the event vocabulary pickle file', default='./data/evocab_freq25')
+    parser.add_argument('--tvocab', type=str, help='the text vocabulary pickle file', default='./data/tvocab_freq100')
+
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+
+    evocab = du.load_vocab(args.evocab)
+    tvocab = du.load_vocab(args.tvocab)
+    build_instance_cache(args.data, args.out, evocab, tvocab)
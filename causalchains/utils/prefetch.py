@@ -0,0 +1,176 @@
+################################
+# Background batch building for the training loops
+# Worker processes build (collate/pad) batches while the model trains,
+# and hand them back through a bounded queue in the same order the
+# plain iterator would have produced them. Batches come out pinned and
+# already on the device, sorted within by decreasing length as before.
+#
+# A source is either
+#   - planned: has epoch_batches(epoch) -> list of index lists, and batch(indices) -> batch
+#     (MappedBatchIter, ExampleBatchPlan); the workers split up the batches of an epoch
+#   - streamed: any other iterable (StreamingInstanceBatches); a single worker runs it
+################################
+import torch
+import torch.multiprocessing as mp
+import numpy as np
+import logging
+import queue
+import torchtext.data as ttdata
+import causalchains.utils.data_utils as du
+from causalchains.utils.instance_cache import length_bucketed_batches
+
+
+class ExampleBatchPlan(object):
+    """
+    Planned source over a torchtext Dataset (InstanceDataset or LmInstanceDataset), batched the same way
+    as BatchIter(dataset, batch_size, sort_key, train, shuffle=train, sort_within_batch=True)
+    """
+
+    def __init__(self, dataset, batch_size, sort_key, train=True, seed=11, batch_class=du.TensorBatch):
+        """
+        Params:
+            sort_key (function) : example -> length, like BatchIter's sort_key
+            batch_class : du.TensorBatch or du.LmTensorBatch, what to convert the torchtext Batch to
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.sort_key = sort_key
+        self.train = train
+        self.seed = seed
+        self.batch_class = batch_class
+        self.sort_lengths = np.array([sort_key(x) for x in dataset.examples])
+
+    def epoch_batches(self, epoch):
+        return length_bucketed_batches(self.sort_lengths, self.batch_size, shuffle=self.train, seed=self.seed + epoch)
+
+    def batch(self, indices):
+        examples = sorted([self.dataset.examples[i] for i in indices], key=self.sort_key, reverse=True) #sort within batch
+        return self.batch_class(ttdata.Batch(examples, self.dataset))
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        'Build the batches of epoch 0 in this process'
+        for indices in self.epoch_batches(0):
+            yield self.batch(indices)
+
+
+def _planned_worker(source, tasks, results):
+    torch.set_num_threads(1)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        idx, indices = task
+        results.put((idx, source.batch(indices)))
+
+
+def _streamed_worker(source, results):
+    torch.set_num_threads(1)
+    for idx, batch in enumerate(source):
+        results.put((idx, batch))
+    results.put(None)
+
+
+class PrefetchBatches(object):
+    'Iterable over the batches of source, built by background worker processes'
+
+    def __init__(self, source, num_workers=2, queue_size=8, device=None, pin_memory=True):
+        """
+        Params:
+            source : a planned or streamed batch source (see top of file)
+            num_workers (int) : number of processes building batches (streamed sources always use one)
+            queue_size (int) : maximum number of batches built ahead of the training loop
+            device : where to send the batches, pinned first if this is a cuda device and pin_memory is set
+        """
+        self.source = source
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.device = device
+        self.pin_memory = pin_memory and device is not None and torch.device(device).type == 'cuda'
+        self.epoch = 0
+        self.skip = 0
+        self.seed = None
+
+    def __len__(self):
+        return len(self.source)
+
+    def set_epoch(self, epoch, skip=0, seed=None):
+        'See data_utils.set_epoch'
+        self.epoch = epoch
+        self.skip = skip
+        self.seed = seed
+
+    def _ready(self, batch):
+        if self.pin_memory:
+            batch = batch.pin_memory()
+        if self.device is not None:
+            batch = batch.to(self.device, non_blocking=self.pin_memory)
+        return batch
+
+    def _planned(self, epoch, skip):
+        plan = self.source.epoch_batches(epoch)[skip:]
+        tasks = mp.Queue()
+        results = mp.Queue()
+        workers = [mp.Process(target=_planned_worker, args=(self.source, tasks, results), daemon=True) for _ in range(self.num_workers)]
+        for worker in workers:
+            worker.start()
+
+        try:
+            sent = 0
+            for _ in range(min(self.queue_size, len(plan))):
+                tasks.put((sent, plan[sent]))
+                sent += 1
+
+            pending = {}
+            for idx in range(len(plan)):
+                while idx not in pending: #batches can finish out of order, hand them out in plan order
+                    done_idx, batch = self._get(results, workers)
+                    pending[done_idx] = batch
+                batch = pending.pop(idx)
+                if sent < len(plan):
+                    tasks.put((sent, plan[sent]))
+                    sent += 1
+                yield self._ready(batch)
+        finally:
+            for worker in workers:
+                tasks.put(None)
+            self._shutdown(workers)
+
+    def _streamed(self, epoch, skip):
+        du.set_epoch(self.source, epoch, skip, self.seed) #the worker gets a copy of source set to this epoch
+        results = mp.Queue(self.queue_size)
+        worker = mp.Process(target=_streamed_worker, args=(self.source, results), daemon=True)
+        worker.start()
+        try:
+            while True:
+                item = self._get(results, [worker])
+                if item is None:
+                    break
+                yield self._ready(item[1])
+        finally:
+            self._shutdown([worker])
+
+    def _get(self, results, workers):
+        #Dont wait forever if a worker died (eg killed by the oom killer)
+        while True:
+            try:
+                return results.get(timeout=5.0)
+            except queue.Empty:
+                if any([not w.is_alive() and w.exitcode != 0 for w in workers]):
+                    raise RuntimeError("A batch worker exited unexpectedly")
+
+    def _shutdown(self, workers):
+        for worker in workers:
+            worker.join(timeout=1.0)
+            if worker.is_alive():
+                worker.terminate()
+
+    def __iter__(self):
+        epoch, skip = self.epoch, self.skip
+        self.epoch += 1
+        self.skip = 0
+        if hasattr(self.source, 'epoch_batches'):
+            return self._planned(epoch, skip)
+        return self._streamed(epoch, skip)
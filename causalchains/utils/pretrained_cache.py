@@ -0,0 +1,71 @@
+################################
+# Pretrained word vectors aligned to the text vocab
+# Build it once with
+#   python -m causalchains.utils.pretrained_cache --vectors glove.6B.300d.txt --out data/glove_6B_300d.npy
+# then train with --use_pretrained --pretrained_embeddings data/glove_6B_300d.npy.
+#
+# Row i is the vector for tvocab.itos[i] (random normal for words without
+# one, zeros for pad), stored as a float32 .npy file that is memory mapped
+# at load time, so only the vectors of the vocab are ever read.
+################################
+import numpy as np
+import argparse
+import logging
+import causalchains.utils.data_utils as du
+from causalchains.utils.data_utils import PAD_TOK
+
+
+def build_pretrained_matrix(vectors_path, text_vocab, out, seed=11, log_every=100000):
+    """
+    Align a word vectors text file (GloVe format, one 'word v1 ... vd' per line) to text_vocab and save it to out
+    Params:
+        seed (int) : for the random vectors of words not in the file (normal, like torchtext's unk_init=torch.Tensor.normal_)
+    Returns:
+        (int) number of vocab words found in the file
+    """
+    matrix = None
+    found = 0
+    with open(vectors_path, 'r', encoding='utf-8', errors='replace') as fi:
+        for line_num, line in enumerate(fi):
+            parts = line.rstrip().split(' ')
+            if matrix is None:
+                if len(parts) == 2: #word2vec style header (count dim)
+                    continue
+                dim = len(parts) - 1
+                matrix = np.random.RandomState(seed).standard_normal((len(text_vocab.itos), dim)).astype(np.float32)
+                have = np.zeros(len(text_vocab.itos), dtype=bool)
+            word = ' '.join(parts[:-dim]) #some files have words with spaces in them
+            idx = text_vocab.stoi.get(word)
+            if idx is not None and not have[idx]: #keep the first vector of a word
+                matrix[idx] = np.asarray(parts[-dim:], dtype=np.float32)
+                have[idx] = True
+                found += 1
+            if line_num % log_every == 0 and line_num != 0:
+                logging.info("Read {} vectors, {} in the vocab".format(line_num, found))
+
+    matrix[text_vocab.stoi[PAD_TOK]] = 0.0
+    np.save(out, matrix)
+    logging.info("Saved {} X {} matrix to {}, found vectors for {} of {} words".format(matrix.shape[0], matrix.shape[1], out, found, len(text_vocab.itos)))
+    return found
+
+
+def load_pretrained_matrix(path, vocab_size, dim):
+    'Memory map a matrix made by build_pretrained_matrix, checking it fits the vocab/embedding size'
+    matrix = np.load(path, mmap_mode='r')
+    if matrix.shape != (vocab_size, dim):
+        raise ValueError("Pretrained matrix {} has shape {}, expected {} (built with a different tvocab or embedding size?)".format(path, matrix.shape, (vocab_size, dim)))
+    return matrix
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Align pretrained word vectors to the text vocab, for --use_pretrained')
+    parser.add_argument('--vectors', type=str, help='word vectors text file, eg. glove.6B.300d.txt')
+    parser.add_argument('--out', type=str, help='.npy file to write')
+    parser.add_argument('--tvocab', type=str, help='the text vocabulary pickle file', default='./data/tvocab_freq100')
+    parser.add_argument('--seed', type=int, default=11, help='seed for the vectors of words without a pretrained one')
+
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+
+    tvocab = du.load_vocab(args.tvocab)
+    build_pretrained_matrix(args.vectors, tvocab, args.out, seed=args.seed)
@@ -0,0 +1,185 @@
+################################################
+#   Long running server for causal queries
+#   Loads the vocab, score matrix, estimator and EventLM
+#   once, then answers batched json queries over localhost
+#   HTTP. Answers are kept in an LRU cache.
+#
+#   POST / with {"queries": [query, ...]}, returns {"results": [result, ...]}
+#   Query types:
+#       {"type": "top_causes", "e2": str, "k": int}
+#       {"type": "top_effects", "e1": str, "k": int}
+#       {"type": "intervention_prob", "e1": str, "e2": str}   P(e2 | do(e1))
+#       {"type": "lm_continuation", "chain": [str], "k": int}
+#       {"type": "predict", "e1": str, "e1_text": str, "e1prev_intext": [str], "k": int}  (estimator's top e2s)
+################################################
+import argparse
+import torch
+import copy
+import torch.nn.functional as F
+from causalchains.utils.data_utils import SOS_TOK, PAD_TOK
+import causalchains.utils.data_utils as du
+import causalchains.utils.score_matrix as score_matrix
+from causalchains.models.estimator_model import EXP_OUTCOME_COMPONENT
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from functools import lru_cache
+import json
+import logging
+import urllib.request
+
+
+class CausalQueries(object):
+    'Answers the queries, everything is loaded once in the constructor'
+
+    def __init__(self, evocab, scores=None, topk_index=None, estimator=None, tvocab=None, lm_model=None, device=None, cache_size=10000):
+        """
+        Params:
+            evocab : The original event vocabulary
+            scores (score_matrix.ScoreMatrix) : output of causalchains.train.testing.normalized_scores_matrix
+            topk_index (score_matrix.TopKIndex) : sparse index of scores, used for top_causes/top_effects if given
+            estimator : a trained estimator from causalchains.models.estimator_model (needs tvocab)
+            lm_model (causalchains.models.LM.EventLM)
+        """
+        self.evocab = evocab
+        self.evocab_lm = du.convert_to_lm_vocab(copy.deepcopy(evocab))
+        self.tvocab = tvocab
+        self.scores = scores
+        self.topk_index = topk_index
+        self.estimator = estimator
+        self.lm_model = lm_model
+        self.device = device
+        self.answer = lru_cache(maxsize=cache_size)(self._answer)
+
+    def answer_all(self, queries):
+        results = []
+        for query in queries:
+            try:
+                results.append(self.answer(json.dumps(query, sort_keys=True)))
+            except (KeyError, ValueError) as e:
+                results.append({'error': str(e)})
+        return results
+
+    def _answer(self, query):
+        #query is a json string so it can be an lru_cache key
+        query = json.loads(query)
+        handler = getattr(self, "_" + query['type'], None)
+        if handler is None:
+            raise ValueError("Unknown query type {}".format(query['type']))
+        return handler(query)
+
+    def _event_idx(self, vocab, event):
+        if event not in vocab.stoi:
+            raise KeyError("{} is not in the event vocab".format(event))
+        return vocab.stoi[event]
+
+    def _top_causes(self, query):
+        col_idx = self._event_idx(self.evocab, query['e2'])
+        source = self.topk_index if self.topk_index is not None else self.scores
+        return source.top_causes(col_idx, query.get('k', 10))
+
+    def _top_effects(self, query):
+        k = query.get('k', 10)
+        row_idx = self.scores.row_stoi[query['e1']] if self.scores is not None else self.topk_index.row_stoi[query['e1']]
+        if self.topk_index is not None:
+            effects = self.topk_index.top_effects(row_idx, k)
+        else:
+            vals, idxs = self.scores.row(row_idx).topk(k)
+            effects = zip(idxs.tolist(), vals.tolist())
+        return [(self.evocab.itos[i], v) for i, v in effects]
+
+    def _intervention_prob(self, query):
+        row_idx = self.scores.row_stoi[query['e1']]
+        col_idx = self._event_idx(self.evocab, query['e2'])
+        if 'normalizer' not in self.scores.metadata:
+            raise ValueError("Score matrix has no saved normalizer, cant unnormalize")
+        return self.scores.value(row_idx, col_idx) * self.scores.metadata['normalizer'][col_idx]
+
+    def _lm_continuation(self, query):
+        chain = [self._event_idx(self.evocab_lm, x) for x in query['chain']]
+        text_inst = torch.LongTensor([self.evocab_lm.stoi[SOS_TOK]] + chain).to(device=self.device) #[seqlen]
+        with torch.no_grad():
+            logits, _ = self.lm_model.prefix_logits(text_inst)
+            log_probs = F.log_softmax(logits[0], dim=0) #after the last event in chain
+        vals, idxs = log_probs.topk(query.get('k', 10))
+        return [(self.evocab_lm.itos[i], v) for i, v in zip(idxs.tolist(), vals.tolist())]
+
+    def _predict(self, query):
+        for event in [query['e1']] + query.get('e1prev_intext', []):
+            self._event_idx(self.evocab, event)
+        #e2 is not used for prediction, unknown text tokens become UNK (numericalize_instance never adds to the vocabs)
+        instance = {'e1': query['e1'], 'e2': PAD_TOK, 'e1_text': query['e1_text'], 'e1prev_intext': query.get('e1prev_intext', [])}
+        instance = du.numericalize_instance(instance, self.evocab, self.tvocab)
+        batch = du.collate_instances([instance], self.evocab.stoi[PAD_TOK], self.tvocab.stoi[PAD_TOK], min_size=self.estimator.text_encoder.largest_ngram_size)
+        with torch.no_grad():
+            output = self.estimator(batch.to(self.device))[EXP_OUTCOME_COMPONENT]
+            probs = F.softmax(output, dim=1).squeeze(0)
+        vals, idxs = probs.topk(query.get('k', 10))
+        return [(self.evocab.itos[i], v) for i, v in zip(idxs.tolist(), vals.tolist())]
+
+
+def make_handler(queries):
+    class QueryHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            try:
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+                response = {'results': queries.answer_all(body['queries'])}
+                code = 200
+            except (KeyError, ValueError) as e:
+                response = {'error': str(e)}
+                code = 400
+            out = json.dumps(response).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return QueryHandler
+
+
+def query(queries, host='127.0.0.1', port=8765):
+    'Client side, send a list of queries to a running server and return the list of results'
+    data = json.dumps({'queries': queries}).encode('utf-8')
+    request = urllib.request.Request("http://{}:{}/".format(host, port), data=data, headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read().decode('utf-8'))['results']
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Causal Query Server')
+    parser.add_argument('--evocab', type=str, help='the event vocabulary pickle file', default='./data/evocab_freq25')
+    parser.add_argument('--tvocab', type=str, help='the text vocabulary pickle file', default='./data/tvocab_freq100')
+    parser.add_argument('--causal_dict', type=str, default=None, help='Matrix output of causalchains.train.testing.normalized_scores_matrix')
+    parser.add_argument('--causal_topk', type=str, default=None, help='Sparse top k index of causal_dict (testing --topk)')
+    parser.add_argument('--model', type=str, default=None, help='Trained estimator, for predict queries')
+    parser.add_argument('--lm_model', type=str, default=None, help='Trained EventLM, for lm_continuation queries')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--cache_size', type=int, default=10000, help='Number of answers to keep in the LRU cache')
+    parser.add_argument('--cuda', action='store_true')
+
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+    args.device = torch.device('cuda') if args.cuda and torch.cuda.is_available() else torch.device('cpu')
+
+    evocab = du.load_vocab(args.evocab)
+    tvocab = du.load_vocab(args.tvocab) if args.model else None
+    scores = score_matrix.load_score_matrix(args.causal_dict) if args.causal_dict else None
+    topk_index = score_matrix.load_topk_index(args.causal_topk) if args.causal_topk else None
+
+    estimator = None
+    if args.model:
+        estimator = torch.load(args.model, map_location=args.device)
+        estimator.eval()
+
+    lm_model = None
+    if args.lm_model:
+        lm_model = torch.load(args.lm_model, map_location=args.device)
+        lm_model.eval()
+
+    queries = CausalQueries(evocab, scores, topk_index, estimator, tvocab, lm_model, device=args.device, cache_size=args.cache_size)
+    server = HTTPServer((args.host, args.port), make_handler(queries))
+    logging.info("Serving on {}:{}".format(args.host, args.port))
+    server.serve_forever()
@@ -0,0 +1,206 @@
+################################################
+#   Binary format for score matrices (output of
+#   causalchains.train.testing), rows are e1s, columns e2s
+#
+#   Layout of the file:
+#       8 byte magic, 8 byte (little endian) header length,
+#       json header, padding up to a 64 byte boundary,
+#       then the raw array stored column major (each e2 column
+#       is contiguous) so columns can be read lazily off a memmap
+################################################
+import torch
+import numpy as np
+import json
+import os
+import pickle
+import struct
+
+MAGIC = b"CCSCORE1"
+ALIGN = 64
+DTYPES = ['float32', 'float16']
+
+
+class ScoreMatrix(object):
+    'A [e1 X e2] score matrix, backed by a memmapped file (or an in memory array for old pickled matrices)'
+
+    def __init__(self, data, row_events, col_events=None, metadata=None):
+        """
+        Params:
+            data (numpy array) : [num e2 X num e1] the matrix, TRANSPOSED so each column is contiguous
+            row_events (list) : string form of the e1 for each row
+            col_events (list) : string form of the e2 for each column (None if not saved)
+            metadata (dict) : anything else saved with the matrix
+        """
+        self.data = data
+        self.row_events = list(row_events)
+        self.row_stoi = dict([(x, i) for i, x in enumerate(self.row_events)])
+        self.col_events = list(col_events) if col_events is not None else None
+        self.metadata = metadata if metadata is not None else {}
+        assert self.data.shape[1] == len(self.row_events)
+
+    @property
+    def shape(self):
+        return (self.data.shape[1], self.data.shape[0])
+
+    def column(self, col_idx):
+        'Return the scores of all e1s for e2 with index col_idx, tensor[num e1]'
+        return torch.from_numpy(np.array(self.data[col_idx], dtype=np.float32))
+
+    def columns(self, col_idxs):
+        'Return the scores of all e1s for each e2 in col_idxs, tensor[num e1 X len(col_idxs)]'
+        return torch.from_numpy(np.array(self.data[list(col_idxs)], dtype=np.float32)).t()
+
+    def value(self, row_idx, col_idx):
+        return float(self.data[col_idx, row_idx])
+
+    def row(self, row_idx):
+        'Return the scores of all e2s for e1 with index row_idx, tensor[num e2] (a strided read, slower than column)'
+        return torch.from_numpy(np.array(self.data[:, row_idx], dtype=np.float32))
+
+    def dense(self):
+        'Load the whole thing, tensor[num e1 X num e2]'
+        return torch.from_numpy(np.array(self.data, dtype=np.float32)).t()
+
+    def top_causes(self, col_idx, k=None):
+        'Return [(e1, score)] for the e2 with index col_idx, sorted by score, best first'
+        col = self.column(col_idx)
+        vals, idxs = col.topk(col.shape[0] if k is None else min(k, col.shape[0]))
+        return [(self.row_events[i], v) for i, v in zip(idxs.tolist(), vals.tolist())]
+
+
+class TopKIndex(object):
+    'Sparse index holding only the k best e1s for each e2 (causes) and the k best e2s for each e1 (effects), in CSR form'
+
+    def __init__(self, arrays, row_events, col_events, k):
+        """
+        Params:
+            arrays (dict) : cause_indptr, cause_indices, cause_scores (one CSR row per e2, indices are e1 rows)
+                            and effect_indptr, effect_indices, effect_scores (one CSR row per e1, indices are e2 columns)
+        """
+        self.arrays = arrays
+        self.row_events = list(row_events)
+        self.row_stoi = dict([(x, i) for i, x in enumerate(self.row_events)])
+        self.col_events = list(col_events) if col_events is not None else None
+        self.k = k
+
+    def _lookup(self, name, idx, k):
+        start, end = self.arrays[name + '_indptr'][idx], self.arrays[name + '_indptr'][idx+1]
+        if k is not None:
+            end = min(end, start + k)
+        return self.arrays[name + '_indices'][start:end].tolist(), self.arrays[name + '_scores'][start:end].tolist()
+
+    def top_causes(self, col_idx, k=None):
+        'Return [(e1, score)] for the e2 with index col_idx, best first (at most self.k of them)'
+        idxs, vals = self._lookup('cause', col_idx, k)
+        return [(self.row_events[i], v) for i, v in zip(idxs, vals)]
+
+    def top_effects(self, row_idx, k=None):
+        'Return [(e2 index, score)] for the e1 with row index row_idx, best first (at most self.k of them)'
+        idxs, vals = self._lookup('effect', row_idx, k)
+        return list(zip(idxs, vals))
+
+
+def build_topk_index(scores, k, block_size=1024):
+    """
+    Params:
+        scores (ScoreMatrix) : the matrix to index, read a block of columns at a time
+        k (int) : number of causes/effects to keep for each e2/e1
+    Returns:
+        TopKIndex
+    """
+    num_rows, num_cols = scores.shape
+    cause_k = min(k, num_rows)
+    effect_k = min(k, num_cols)
+    cause_scores, cause_indices = [], []
+    effect_scores = torch.zeros(num_rows, 0)
+    effect_indices = torch.zeros(num_rows, 0, dtype=torch.long)
+
+    for start in range(0, num_cols, block_size):
+        block = scores.columns(range(start, min(start+block_size, num_cols))) #[num e1 X block]
+        vals, idxs = block.topk(cause_k, dim=0)
+        cause_scores.append(vals.t())
+        cause_indices.append(idxs.t())
+
+        #Keep a running top k over the columns for each row
+        merged_scores = torch.cat([effect_scores, block], dim=1)
+        merged_indices = torch.cat([effect_indices, torch.arange(start, start+block.shape[1]).unsqueeze(0).expand(num_rows, block.shape[1])], dim=1)
+        effect_scores, top = merged_scores.topk(min(effect_k, merged_scores.shape[1]), dim=1)
+        effect_indices = torch.gather(merged_indices, 1, top)
+
+    arrays = {'cause_indptr': np.arange(num_cols+1, dtype=np.int64)*cause_k,
+              'cause_indices': torch.cat(cause_indices, dim=0).contiguous().view(-1).numpy().astype(np.int32),
+              'cause_scores': torch.cat(cause_scores, dim=0).contiguous().view(-1).numpy(),
+              'effect_indptr': np.arange(num_rows+1, dtype=np.int64)*effect_k,
+              'effect_indices': effect_indices.contiguous().view(-1).numpy().astype(np.int32),
+              'effect_scores': effect_scores.contiguous().view(-1).numpy()}
+    return TopKIndex(arrays, scores.row_events, scores.col_events, k)
+
+
+def save_topk_index(path, index):
+    col_events = index.col_events if index.col_events is not None else []
+    with open(path, 'wb') as fi: #pass a file so numpy doesnt tack on .npz
+        np.savez(fi, row_events=np.array(index.row_events), col_events=np.array(col_events), k=np.array(index.k), **index.arrays)
+
+
+def load_topk_index(path):
+    loaded = np.load(path)
+    arrays = dict([(name, loaded[name]) for name in loaded.files if name not in ['row_events', 'col_events', 'k']])
+    col_events = loaded['col_events'].tolist()
+    return TopKIndex(arrays, loaded['row_events'].tolist(), col_events if col_events else None, int(loaded['k']))
+
+
+def save_score_matrix(path, scores, row_events, col_events=None, dtype='float32', metadata=None, block_size=1024):
+    """
+    Params:
+        scores (Tensor) : [num e1 X num e2] matrix to save
+        row_events (list) : string form of the e1 for each row
+        col_events (list) : string form of the e2 for each column
+        dtype (str) : one of DTYPES
+        block_size (int) : number of columns to convert and write at a time
+    """
+    assert dtype in DTYPES, "dtype must be one of {}".format(DTYPES)
+    assert scores.shape[0] == len(row_events)
+    header = {'dtype': dtype,
+              'shape': [scores.shape[0], scores.shape[1]],
+              'row_events': list(row_events),
+              'col_events': list(col_events) if col_events is not None else None,
+              'metadata': metadata if metadata is not None else {}}
+    header = json.dumps(header).encode('utf-8')
+    data_offset = len(MAGIC) + 8 + len(header)
+    padding = (ALIGN - data_offset % ALIGN) % ALIGN
+
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    with open(tmp_path, 'wb') as fi:
+        fi.write(MAGIC)
+        fi.write(struct.pack('<Q', len(header)))
+        fi.write(header)
+        fi.write(b"\0"*padding)
+        for start in range(0, scores.shape[1], block_size):
+            block = scores[:, start:start+block_size].t().contiguous().cpu().numpy()
+            fi.write(block.astype(dtype).tobytes())
+    os.replace(tmp_path, path)
+
+
+def load_score_matrix(path):
+    """
+    Load a score matrix saved with save_score_matrix (memmapped, nothing is read until asked for),
+    or an old pickled (scores, so_events_itos, so_events_stoi) tuple
+    Returns:
+        ScoreMatrix
+    """
+    with open(path, 'rb') as fi:
+        magic = fi.read(len(MAGIC))
+        if magic != MAGIC:
+            fi.seek(0)
+            scores, itos, stoi = pickle.load(fi)
+            scores = np.ascontiguousarray(np.asarray(scores, dtype=np.float32).T)
+            return ScoreMatrix(scores, [x[1] for x in itos], metadata={'legacy_pickle': True})
+
+        header_len = struct.unpack('<Q', fi.read(8))[0]
+        header = json.loads(fi.read(header_len).decode('utf-8'))
+
+    data_offset = len(MAGIC) + 8 + header_len
+    data_offset += (ALIGN - data_offset % ALIGN) % ALIGN
+    num_rows, num_cols = header['shape']
+    data = np.memmap(path, dtype=header['dtype'], mode='r', offset=data_offset, shape=(num_cols, num_rows))
+    return ScoreMatrix(data, header['row_events'], header['col_events'], header['metadata'])
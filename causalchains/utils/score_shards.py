@@ -0,0 +1,96 @@
+################################################
+#   On disk shards for the intervention score matrix
+#   The rows (intervened e1s) are split into blocks, each
+#   finished block goes to its own file, and a manifest
+#   records how the events were split. Lets a long scoring
+#   job pick up where it left off, or be split across machines
+################################################
+import torch
+import os
+import json
+import logging
+
+MANIFEST = "manifest.json"
+
+
+def atomic_save(obj, path):
+    #Write to a temp file first so a crash never leaves a half written file at path
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def shard_path(shard_dir, shard_idx):
+    return os.path.join(shard_dir, "shard_{:05d}.pt".format(shard_idx))
+
+
+def plan_shards(events, shard_size, num_events):
+    'Split events into shards of shard_size rows, returns the manifest (without writing it anywhere)'
+    return {'events': list(events),
+            'num_events': num_events,
+            'shard_size': shard_size,
+            'num_shards': (len(events) + shard_size - 1) // shard_size}
+
+
+def load_manifest(shard_dir, events, shard_size, num_events):
+    """
+    Load the manifest in shard_dir, creating it if this is a new job
+    Params:
+        events (list) : string form of all the events that get a row in the matrix (in row order)
+        shard_size (int) : number of rows per shard
+        num_events (int) : number of columns (size of the event vocab the model predicts)
+    Returns:
+        (dict) the manifest
+    """
+    manifest_file = os.path.join(shard_dir, MANIFEST)
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as fi:
+            manifest = json.load(fi)
+        if manifest['events'] != list(events) or manifest['num_events'] != num_events:
+            raise ValueError("Shards in {} were computed for a different set of events, use a new shard directory".format(shard_dir))
+        logging.info("Resuming from {}, shard size {}".format(shard_dir, manifest['shard_size']))
+        return manifest
+
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    manifest = plan_shards(events, shard_size, num_events)
+
+    tmp_file = "{}.tmp{}".format(manifest_file, os.getpid())
+    with open(tmp_file, 'w') as fi:
+        json.dump(manifest, fi)
+    os.replace(tmp_file, manifest_file)
+    return manifest
+
+
+def shard_bounds(manifest, shard_idx):
+    'Return the (start, end) rows covered by shard_idx'
+    start = shard_idx * manifest['shard_size']
+    return start, min(start + manifest['shard_size'], len(manifest['events']))
+
+
+def completed_shards(shard_dir, manifest):
+    return set([i for i in range(manifest['num_shards']) if os.path.exists(shard_path(shard_dir, i))])
+
+
+def write_shard(shard_dir, shard_idx, dists):
+    """
+    Params:
+        dists (Tensor) : [shard rows X num events] unnormalized intervention distributions for the shard
+    """
+    atomic_save(dists, shard_path(shard_dir, shard_idx))
+
+
+def merge_shards(shard_dir, manifest):
+    """
+    Stack all shards into the full (still unnormalized) matrix, every shard must be done
+    Returns:
+        Tensor [len(events) X num events]
+    """
+    dists = []
+    for shard_idx in range(manifest['num_shards']):
+        start, end = shard_bounds(manifest, shard_idx)
+        shard = torch.load(shard_path(shard_dir, shard_idx))
+        assert shard.shape == (end - start, manifest['num_events']), "Shard {} has the wrong shape".format(shard_idx)
+        dists.append(shard)
+    return torch.cat(dists, dim=0)
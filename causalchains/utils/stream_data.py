@@ -0,0 +1,156 @@
+################################
+# Streaming batches of InstanceDataset instances, for corpora
+# too big to load into memory. Reads a list of shards (InstanceDataset
+# jsonl files, or instance_cache directories) one instance at a time,
+# mixes them with a shuffle buffer, and buckets by length within a window
+# of batches. The order for an epoch only depends on seed and the epoch number.
+################################
+import random
+import argparse
+import json
+import os
+import glob
+import logging
+import causalchains.utils.data_utils as du
+from causalchains.utils.data_utils import PAD_TOK
+from causalchains.utils.instance_cache import META, MappedInstanceDataset, SCALAR_FIELDS, SEQUENCE_FIELDS
+
+
+def expand_shards(patterns):
+    'Expand a list of filenames/glob patterns into a sorted list of shards'
+    shards = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise ValueError("No shards match {}".format(pattern))
+        shards.extend(matches)
+    return shards
+
+
+class StreamingInstanceBatches(object):
+    """
+    Iterable over TensorBatches, used in place of BatchIter over an InstanceDataset.
+    Each pass (epoch) shuffles the shard order, streams instances through a shuffle buffer of
+    shuffle_buffer instances, sorts windows of bucket_window batches worth of instances by allprev
+    length, and yields those batches in random order (each sorted within by decreasing allprev length
+    like BatchIter with sort_within_batch)
+    """
+
+    def __init__(self, shards, event_vocab, text_vocab, batch_size, min_size=5, shuffle_buffer=100000, bucket_window=100, seed=11, shuffle=True):
+        """
+        Params:
+            shards (list) : InstanceDataset jsonl files or directories made by causalchains.utils.instance_cache
+            min_size : the minimum size of text fields, pad to this size if it is not larger
+            shuffle (bool) : If False, stream instances in file order with no bucketing (for validation)
+        """
+        self.shards = list(shards)
+        self.event_vocab = event_vocab
+        self.text_vocab = text_vocab
+        self.batch_size = batch_size
+        self.min_size = min_size
+        self.shuffle_buffer = shuffle_buffer
+        self.bucket_window = bucket_window
+        self.seed = seed
+        self.shuffle = shuffle
+        self.epoch = 0
+        self.skip = 0
+        self.e_pad = event_vocab.stoi[PAD_TOK]
+        self.t_pad = text_vocab.stoi[PAD_TOK]
+
+    def read_shard(self, shard):
+        'Generator over the numericalized instances (dicts from du.numericalize_instance) in shard'
+        if os.path.isdir(shard) and os.path.exists(os.path.join(shard, META)):
+            dataset = MappedInstanceDataset(shard)
+            for i in range(len(dataset)):
+                instance = dict([(name, int(dataset.ids[name][i])) for name in SCALAR_FIELDS])
+                for name in SEQUENCE_FIELDS:
+                    start, end = dataset.offsets[name][i], dataset.offsets[name][i+1]
+                    instance[name] = dataset.tokens[name][start:end].tolist()
+                yield instance
+        else:
+            with open(shard, 'r') as fi:
+                for line in fi:
+                    json_line = json.loads(line)
+                    if json_line['e1'] not in self.event_vocab.stoi or json_line['e2'] not in self.event_vocab.stoi:
+                        continue
+                    yield du.numericalize_instance(json_line, self.event_vocab, self.text_vocab)
+
+    def instances(self, rng):
+        'Generator over all instances, through the shuffle buffer'
+        shards = list(self.shards)
+        if self.shuffle:
+            rng.shuffle(shards)
+        buffer = []
+        for shard in shards:
+            logging.debug("Streaming shard {}".format(shard))
+            for instance in self.read_shard(shard):
+                if not self.shuffle:
+                    yield instance
+                elif len(buffer) < self.shuffle_buffer:
+                    buffer.append(instance)
+                else:
+                    idx = rng.randrange(len(buffer))
+                    yield buffer[idx]
+                    buffer[idx] = instance
+        rng.shuffle(buffer)
+        for instance in buffer:
+            yield instance
+
+    def set_epoch(self, epoch, skip=0, seed=None):
+        'See data_utils.set_epoch, skipped batches still get read (but not padded)'
+        self.epoch = epoch
+        self.skip = skip
+
+    def make_batch(self, instances):
+        instances = sorted(instances, key=lambda x: len(x['allprev']), reverse=True) #sort within batch
+        return du.collate_instances(instances, self.e_pad, self.t_pad, min_size=self.min_size)
+
+    def batches(self, rng):
+        window_size = self.batch_size*self.bucket_window if self.shuffle else self.batch_size
+        window = []
+
+        def flush(window):
+            if self.shuffle:
+                window = sorted(window, key=lambda x: len(x['allprev']))
+            batches = [window[i:i+self.batch_size] for i in range(0, len(window), self.batch_size)]
+            if self.shuffle:
+                rng.shuffle(batches)
+            return batches
+
+        for instance in self.instances(rng):
+            window.append(instance)
+            if len(window) == window_size:
+                for batch in flush(window):
+                    yield batch
+                window = []
+        if window:
+            for batch in flush(window):
+                yield batch
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        skip = self.skip
+        self.epoch += 1
+        self.skip = 0
+        for idx, batch in enumerate(self.batches(rng)):
+            if idx >= skip:
+                yield self.make_batch(batch)
+
+
+if __name__ == "__main__":
+    #Quick look at how an epoch gets batched
+    parser = argparse.ArgumentParser(description='Stream batches from InstanceDataset shards')
+    parser.add_argument('--shards', type=str, nargs='+')
+    parser.add_argument('--evocab', type=str, help='the event vocabulary pickle file', default='./data/evocab_freq25')
+    parser.add_argument('--tvocab', type=str, help='the text vocabulary pickle file', default='./data/tvocab_freq100')
+    parser.add_argument('--batch_size', type=int, default=32)
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+
+    batches = StreamingInstanceBatches(expand_shards(args.shards), du.load_vocab(args.evocab), du.load_vocab(args.tvocab), args.batch_size)
+    num_batches = 0
+    num_instances = 0
+    for batch in batches:
+        num_batches += 1
+        num_instances += len(batch)
+    logging.info("{} instances in {} batches".format(num_instances, num_batches))
@@ -0,0 +1,34 @@
+import pytest
+from types import SimpleNamespace
+from collections import defaultdict
+
+
+def tiny_vocab(size):
+    'Stand in for a torchtext Vocab with size entries, UNK is 0 and PAD is 1, stoi is a defaultdict (to UNK) like in torchtext'
+    from causalchains.utils.data_utils import UNK_TOK, PAD_TOK
+    itos = [UNK_TOK, PAD_TOK] + ['w{}'.format(i) for i in range(2, size)]
+    stoi = defaultdict(int)
+    stoi.update([(w, i) for i, w in enumerate(itos)])
+    return SimpleNamespace(itos=itos, stoi=stoi)
+
+
+@pytest.fixture
+def evocab():
+    return tiny_vocab(9)
+
+
+@pytest.fixture
+def tvocab():
+    return tiny_vocab(12)
+
+
+@pytest.fixture
+def make_config():
+    'Factory for tiny estimator configs, keyword arguments override the defaults'
+    def make(**kwargs):
+        config = SimpleNamespace(event_embed_size=4, text_embed_size=6, text_enc_output=5, rnn_hidden_dim=3, use_pretrained=False,
+                                 combine_events=False, rnn_event_encoder=False, finetune=False)
+        for name, value in kwargs.items():
+            setattr(config, name, value)
+        return config
+    return make
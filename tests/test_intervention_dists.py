@@ -0,0 +1,55 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchtext")
+import causalchains.utils.data_utils as du
+import causalchains.models.estimator_model as estimators
+import causalchains.train.testing as testing
+
+
+def tiny_batch(e1, prev, outtext, pad, num_text=12):
+    'A TensorBatch from lists of ids, prev must be sorted by decreasing length (for the rnn encoders)'
+    def padded(seqs):
+        lengths = [len(x) for x in seqs]
+        width = max(max(lengths), 1)
+        return (torch.LongTensor([x + [pad] * (width - len(x)) for x in seqs]), torch.LongTensor(lengths))
+
+    return du.TensorBatch.from_fields({'e1_text': (torch.randint(2, num_text, (len(e1), 7)), torch.LongTensor([7] * len(e1))),
+                                       'e1': torch.LongTensor(e1),
+                                       'e2': torch.randint(2, 9, (len(e1),)),
+                                       'e1prev_intext': padded(prev),
+                                       'allprev': padded([p + [e] for p, e in zip(prev, e1)]),
+                                       'e1prev_outtext': padded(outtext)})
+
+
+def tiny_model(encoder, evocab, tvocab, make_config):
+    if encoder == 'onehot':
+        return estimators.SemiNaiveAdjustmentEstimatorOneHotEvents(make_config(), evocab, tvocab)
+    elif encoder == 'average':
+        return estimators.SemiNaiveAdjustmentEstimator(make_config(), evocab, tvocab)
+    elif encoder == 'combine': #e1 averaged in with the previous events, scaled by 1/(len+1) in encode_context
+        return estimators.SemiNaiveAdjustmentEstimator(make_config(combine_events=True), evocab, tvocab)
+    old_model = estimators.SemiNaiveAdjustmentEstimator(make_config(rnn_event_encoder=True), evocab, tvocab)
+    if encoder == 'rnn':
+        return old_model
+    model = estimators.AdjustmentEstimator(make_config(rnn_event_encoder=True, finetune=True), evocab, tvocab, old_model)
+    model.expected_outcome.logits_mlp.weight.data.normal_() #starts at zero, which would leave the out of text events untested
+    return model
+
+
+@pytest.mark.parametrize('encoder', ['onehot', 'average', 'combine', 'rnn', 'finetune'])
+def test_factorized_matches_no_factorize(encoder, evocab, tvocab, make_config):
+    torch.manual_seed(11)
+    pad = evocab.stoi[du.PAD_TOK]
+    model = tiny_model(encoder, evocab, tvocab, make_config)
+    model.eval()
+
+    batches = [tiny_batch([3, 0, 8, 5], [[5, 3, 5], [4, 7], [2], []], [[6], [], [2, 4], [7]], pad),
+               tiny_batch([2, 6], [[8, 8], []], [[], [3]], pad)]
+    e1s = [x for x in evocab.itos if x != du.PAD_TOK]
+    num_examples = sum([len(batch) for batch in batches])
+
+    baseline = torch.stack([testing.intervention_dist(batches, model, e1, evocab, num_examples) for e1 in e1s], dim=0)
+    factorized = testing.intervention_dists(batches, model, e1s, evocab, num_examples, e1_chunk=3)
+
+    assert torch.allclose(factorized, baseline, atol=1e-5)
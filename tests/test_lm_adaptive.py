@@ -0,0 +1,26 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchtext")
+import torch.nn.functional as F
+from causalchains.models.LM import EventLM
+
+
+def test_adaptive_head_moves_eos_and_keeps_vocab_order():
+    torch.manual_seed(11)
+    nvocab, eos = 12, 11
+    model = EventLM(4, 5, 1, nvocab, dropout=0.0, adaptive_cutoffs=[3, 7], adaptive_head=[eos])
+    model.eval()
+    assert model.adaptive_ids[eos].item() == 0 #in the head cluster
+
+    input = torch.LongTensor([[10, 2, 5, 7], [10, 3, 4, 0]])
+    lengths = torch.LongTensor([4, 3])
+    targets = torch.LongTensor([[2, 5, 7, eos], [3, 4, eos, 0]])
+    with torch.no_grad():
+        output, _ = model.encode(input, None, lengths)
+        log_probs = model.output_logits(output) #vocab order
+        loss = model.sequence_loss(input, lengths, targets, lengths)
+
+    assert torch.allclose(log_probs.exp().sum(dim=1), torch.ones(log_probs.shape[0]), atol=1e-5)
+    mask = (torch.arange(4).unsqueeze(0) < lengths.unsqueeze(1)).view(-1)
+    assert torch.allclose(loss, F.nll_loss(log_probs[mask], targets.view(-1)[mask]), atol=1e-5)
@@ -0,0 +1,35 @@
+import pytest
+from types import SimpleNamespace
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchtext")
+import torch.nn.functional as F
+import causalchains.utils.data_utils as du
+from causalchains.models.estimator_model import SemiNaiveAdjustmentEstimatorOneHotEvents
+
+
+def test_multihot_logits_match_dense(evocab, tvocab, make_config):
+    torch.manual_seed(11)
+    model = SemiNaiveAdjustmentEstimatorOneHotEvents(make_config(), evocab, tvocab).expected_outcome
+    pad = evocab.stoi[du.PAD_TOK]
+
+    #e1 repeated among the previous events (row 0), pads (rows 1, 2), a row with no previous events (row 2)
+    batch = SimpleNamespace(e1=torch.LongTensor([3, 0, 8]),
+                            e1_text=(torch.randint(2, 12, (3, 7)), torch.LongTensor([7, 6, 5])),
+                            e1prev_intext=(torch.LongTensor([[5, 3, 5, 2], [4, 7, pad, pad], [pad, pad, pad, pad]]), torch.LongTensor([4, 2, 0])))
+
+    dense_events = torch.zeros(3, len(evocab.itos))
+    for row, ids in enumerate(torch.cat([batch.e1.unsqueeze(1), batch.e1prev_intext[0]], dim=1).tolist()):
+        for idx in ids:
+            if idx != pad:
+                dense_events[row, idx] = 1.0
+    text_mask = du.create_mask(batch.e1_text[0], batch.e1_text[1])
+    encoded_text = model.text_encoder(model.text_embeddings(batch.e1_text[0]), mask=text_mask)
+    dense = F.linear(torch.cat([dense_events, encoded_text], dim=1), model.logits_mlp.weight, model.logits_mlp.bias)
+
+    assert torch.allclose(model(batch), dense, atol=1e-5)
+
+    targets, sampled = torch.LongTensor([2, 6, 0]), torch.LongTensor([1, 4, 8])
+    target_logits, sampled_logits = model.sampled_logits(batch, targets, sampled)
+    assert torch.allclose(target_logits, dense.gather(1, targets.unsqueeze(1)).squeeze(1), atol=1e-5)
+    assert torch.allclose(sampled_logits, dense[:, sampled], atol=1e-5)
@@ -0,0 +1,24 @@
+import pytest
+import json
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchtext")
+import causalchains.utils.data_utils as du
+from causalchains.utils.stream_data import StreamingInstanceBatches
+
+
+def test_streaming_leaves_vocabs_unchanged(tmp_path, evocab, tvocab):
+    lines = [{'e1': 'w2', 'e2': 'w3', 'e1_text': 'w4 unseen words w5', 'e1prev_intext': ['new_event', 'w6'], 'e1prev_outtext': ['other_event']},
+             {'e1': 'new_event', 'e2': 'w3', 'e1_text': 'w4', 'e1prev_intext': [], 'e1prev_outtext': []}, #unk e1, filtered out
+             {'e1': 'w5', 'e2': 'other_event', 'e1_text': 'w7', 'e1prev_intext': [], 'e1prev_outtext': []}] #unk e2, filtered out
+    shard = tmp_path / 'shard.jsonl'
+    shard.write_text(''.join([json.dumps(x) + '\n' for x in lines]))
+    evocab_size, tvocab_size = len(evocab.stoi), len(tvocab.stoi)
+
+    batches = list(StreamingInstanceBatches([str(shard)], evocab, tvocab, batch_size=4, shuffle=False))
+
+    assert len(evocab.stoi) == evocab_size and len(tvocab.stoi) == tvocab_size
+    assert sum([len(batch) for batch in batches]) == 1
+    assert batches[0].e1prev_intext[0][0].tolist() == [evocab.stoi[du.UNK_TOK], evocab.stoi['w6']]
+    t_unk = tvocab.stoi[du.UNK_TOK]
+    assert batches[0].e1_text[0][0].tolist()[:4] == [tvocab.stoi['w4'], t_unk, t_unk, tvocab.stoi['w5']]